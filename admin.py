@@ -1,64 +1,181 @@
 from __future__ import print_function  # Needed if you want to have console output using Flask
-import requests
+import asyncio
 import json
-from webexteamssdk import WebexTeamsAPI, ApiError
+import os
+import threading
+import time
+from webexteamssdk import ApiError
+from cache import TTLCache, MISSING
+import aio
 import helper
+import transport
+import workspaces
 
+TOKEN_CHECK_TTL = int(os.environ.get("TOKEN_CHECK_TTL", 300))  # seconds a token check result is trusted
+WORKSPACE_CACHE_SIZE = int(os.environ.get("WORKSPACE_CACHE_SIZE", 1000))  # workspace names kept per org
+WORKSPACE_CACHE_TTL = int(os.environ.get("WORKSPACE_CACHE_TTL", 3600))
+WORKSPACE_MISS_TTL = int(os.environ.get("WORKSPACE_MISS_TTL", 30))  # how long a name is remembered as missing
+BULK_WORKERS = int(os.environ.get("BULK_WORKERS", 4))  # parallel provisioning requests per bulk command
+CODE_REUSE_TTL = int(os.environ.get("CODE_REUSE_TTL", 600))  # seconds an issued code is handed out again
 
-# The entity making calls on the organization
+workspace_caches = {}  # maps each org to its cache of workspace names to IDs
+code_caches = {}  # maps each org to its recently issued activation codes
+caches_lock = threading.Lock()
+
+
+def get_org_cache(caches, org_id, maxsize, ttl) -> TTLCache:
+    with caches_lock:
+        cache = caches.get(org_id)
+        if cache is None:
+            cache = TTLCache(maxsize=maxsize, ttl=ttl)
+            caches[org_id] = cache
+        return cache
+
+
+# Returns the workspace name -> ID cache of an org. Shared by all admins of that org.
+def get_workspace_cache(org_id) -> TTLCache:
+    return get_org_cache(workspace_caches, org_id, WORKSPACE_CACHE_SIZE, WORKSPACE_CACHE_TTL)
+
+
+# Returns the (workspace name, model) -> (activation code, when it was issued) cache of an org. Repeated
+# submissions for the same workspace within CODE_REUSE_TTL get the same code instead of minting a new one.
+def get_code_cache(org_id) -> TTLCache:
+    return get_org_cache(code_caches, org_id, WORKSPACE_CACHE_SIZE, CODE_REUSE_TTL)
+
+
+# The entity making calls on the organization. The bot keeps one per org and token, shared by all rooms
+# using them (room_id is the room it was created for).
 class Admin:
 
-    def __init__(self, my_token: str, org_id: str, room_id: str):
+    def __init__(self, my_token: str, org_id: str, room_id: str, token_set_at=None):
         self.my_token = my_token
         self.org_id = org_id
         self.room_id = room_id
-        self.api = WebexTeamsAPI(access_token=self.my_token)
-        self.headers = self.get_headers()
+        self.token_set_at = token_set_at  # when the token was given to the bot (epoch seconds), None if unknown
+        self.api = transport.get_api(self.my_token)
+        # result of the last token check and when it was made
+        self.token_valid = False
+        self.token_checked_at = None
+        self.my_id = None  # looked up by verify(), empty if the token was rejected
+        self.aio = AsyncAdmin(self)  # the workspace and device calls, on the async client
+
+    # Looks up the token's person ID. Returns False if the token was rejected (401 or 403); any other error
+    # is raised, the token could not be checked and is left to be checked on first use.
+    def verify(self) -> bool:
         try:
             self.my_id = self.api.people.me().id
-        except ApiError:
+        except ApiError as e:
+            if e.response.status_code not in (401, 403):
+                raise
             self.my_id = ""
+        return self.my_id != ""
+
+    # Checks if the token may act on the org. The result is cached for TOKEN_CHECK_TTL seconds unless forced.
+    def token_is_valid(self, force=False):
+        cached = self.cached_token_check()
+        if not force and cached is not None:
+            return cached
+        return aio.run(self.aio.token_is_valid(force=True))
+
+    # Result of the last token check if it is recent enough, else None
+    def cached_token_check(self):
+        if self.token_checked_at is not None and time.monotonic() - self.token_checked_at < TOKEN_CHECK_TTL:
+            return self.token_valid
+        return None
+
+    def set_token_valid(self, valid) -> None:
+        self.token_valid = valid
+        self.token_checked_at = time.monotonic()
+
+    # Forgets the cached token check, so the next check asks the API again
+    def invalidate_token(self) -> None:
+        self.token_checked_at = None
+
+    # Updates the cached token check from the status of a real call
+    def check_response(self, response) -> None:
+        if response.status_code in (401, 403):
+            print(f"Token rejected with status {response.status_code}.")
+            self.set_token_valid(False)
+        elif response.ok:
+            self.set_token_valid(True)
+
+    # The calls below run on the async client (see AsyncAdmin), these wrappers wait for their result.
+
+    # Checks if workspace name exists, creates workspace if not and returns ID
+    def get_workspace_id(self, workspace_name) -> str:
+        return aio.run(self.aio.get_workspace_id(workspace_name))
 
-    def token_is_valid(self):
-        response = requests.get(
-            url=f'https://webexapis.com/v1/workspaces?orgId={self.org_id}',
-            headers=self.headers)
+    # Gets activation code for a workspace
+    def get_activation_code(self, workspace_name, model=None) -> str:
+        return aio.run(self.aio.get_activation_code(workspace_name, model))
+
+    # Gets activation codes for several workspaces. Returns a dict of workspace name to code, with an empty
+    # code for each workspace that failed.
+    def get_activation_codes(self, workspace_names, model=None) -> dict:
+        return aio.run(self.aio.get_activation_codes(workspace_names, model))
+
+    def save(self):
+        data = {
+            "admin_token": self.my_token,
+            "org_id": self.org_id
+        }
+        return data
+
+
+# asyncio implementation of the Admin's calls on workspaces and devices. Uses the Admin's token and shares
+# its token check and the org's caches, so sync and async callers see the same state.
+# Need to use plain HTTP here since Webex SDK doesn't yet support workspaces & devices
+class AsyncAdmin:
+
+    def __init__(self, admin: Admin):
+        self.admin = admin
+
+    async def token_is_valid(self, force=False) -> bool:
+        cached = self.admin.cached_token_check()
+        if not force and cached is not None:
+            return cached
+        # Listing a single workspace is enough to know if the token works for this org
+        try:
+            response = await aio.get("workspaces", self.admin.my_token, params={"orgId": self.admin.org_id, "max": 1})
+        except aio.ERRORS as e:
+            print(f"Token check failed: {e!r}")
+            return False
+        status_code = response.status_code
         response = helper.load_text(response)
         if isinstance(response, dict) and "items" in response.keys():
             print("Token valid.")
+            self.admin.set_token_valid(True)
             return True
+        elif status_code == 429 or status_code >= 500:
+            # says nothing about the token, so the result is not cached
+            print(f"Token check inconclusive. Response received: {response}")
+            return False
         else:
             print(f"Token assumed invalid. Response received: {response}")
+            self.admin.set_token_valid(False)
             return False
 
-    def update_token(self, token):
-        self.my_token = token
-        self.headers = self.get_headers()
-        try:
-            self.my_id = self.api.people.me().id
-        except ApiError:
-            self.my_id = ""
-        return self.my_id
-
-    def get_headers(self) -> dict:
-        headers = {
-            "Authorization": "Bearer " + self.my_token,
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        }
-        return headers
-
-    # Need to use requests library here since Webex SDK doesn't yet support workspaces & devices
     # Is called by get_activation_code. Checks if workspace name exists, creates workspace if not and returns ID
-    def get_workspace_id(self, workspace_name) -> str:
-        workspace_id = ""
+    async def get_workspace_id(self, workspace_name) -> str:
+        workspace_cache = get_workspace_cache(self.admin.org_id)
+        cached = workspace_cache.get(workspace_name)
+        if cached is MISSING:
+            # looked up moments ago and not found, go straight to creating it
+            return await self.create_workspace(workspace_name)
+        if cached is not None:
+            print(f"Workspace {cached} cached.")
+            return cached
+        workspace_id = workspaces.get_index(self.admin.org_id).get_id(workspace_name)
+        if workspace_id != "":
+            workspace_cache.set(workspace_name, workspace_id)
+            return workspace_id
         # Get ID for specified workspace name
         try:
-            response = requests.get(
-                url=f'https://webexapis.com/v1/workspaces?orgId={self.org_id}&displayName={workspace_name}',
-                headers=self.headers)
-        except ApiError:
+            response = await aio.get("workspaces", self.admin.my_token,
+                                     params={"orgId": self.admin.org_id, "displayName": workspace_name})
+        except aio.ERRORS:
             return ""
+        self.admin.check_response(response)
         if helper.is_json(response) and "items" in response.json().keys():
             for workspace in response.json()["items"]:
                 workspace_id = workspace["id"]
@@ -67,56 +184,91 @@ class Admin:
             return ""
         # Create workspace if it doesn't exist
         if workspace_id == "":
-            print(f"Creating workspace {workspace_name}.")
-            payload = {
-                "displayName": workspace_name,
-                "orgId": self.org_id
-            }
-            try:
-                response = requests.post(url="https://webexapis.com/v1/workspaces",
-                                     data=json.dumps(payload), headers=self.headers)
-            except ApiError:
-                return ""
-            # print(response.content)
-            if helper.is_json(response):
-                workspace_id = json.loads(response.content)["id"]
-            else:
-                print(f"Something went wrong. Response: {helper.load_text(response)}")
-                return ""
+            workspace_cache.set(workspace_name, MISSING, ttl=WORKSPACE_MISS_TTL)
+            return await self.create_workspace(workspace_name)
+        print(f"Workspace {workspace_id} exists.")
+        workspace_cache.set(workspace_name, workspace_id)
+        workspaces.get_index(self.admin.org_id).add(workspace_name, workspace_id)
+        return workspace_id
+
+    # Creates a workspace and returns its ID
+    async def create_workspace(self, workspace_name) -> str:
+        print(f"Creating workspace {workspace_name}.")
+        payload = {
+            "displayName": workspace_name,
+            "orgId": self.admin.org_id
+        }
+        try:
+            response = await aio.post("workspaces", self.admin.my_token, data=json.dumps(payload))
+        except aio.ERRORS:
+            return ""
+        self.admin.check_response(response)
+        if helper.is_json(response) and "id" in response.json().keys():
+            workspace_id = response.json()["id"]
         else:
-            print(f"Workspace {workspace_id} exists.")
+            print(f"Something went wrong. Response: {helper.load_text(response)}")
+            return ""
+        get_workspace_cache(self.admin.org_id).set(workspace_name, workspace_id)
+        workspaces.get_index(self.admin.org_id).add(workspace_name, workspace_id)
         return workspace_id
 
-    # Need to use requests library here since Webex SDK doesn't yet support workspaces & devices
     # Gets activation code for a workspace
-    def get_activation_code(self, workspace_name, model=None) -> str:
-        # check if token is valid
-        if not self.token_is_valid():
+    async def get_activation_code(self, workspace_name, model=None) -> str:
+        code_cache = get_code_cache(self.admin.org_id)
+        issued = code_cache.get((workspace_name, model))
+        if issued is not None:
+            print(f"Reusing activation code issued for workspace {workspace_name}.")
+            return issued[0]
+        # check if token is valid, usually answered from the cached check
+        if not await self.token_is_valid():
             return ""
         # Get ID for specified workspace name
-        workspace_id = self.get_workspace_id(workspace_name)
+        workspace_id = await self.get_workspace_id(workspace_name)
         if workspace_id == "":
             return ""
-        payload = {"workspaceId": workspace_id}
-        if model:
-            payload["model"] = model
-        # Create activation code
-        try:
-            response = requests.post(url="https://webexapis.com/v1/devices/activationCode?orgId=" + self.org_id,
-                                 data=json.dumps(payload), headers=self.headers)
-        except ApiError:
+        response = await self.post_activation_code(workspace_id, model)
+        if response is not None and response.status_code == 404:
+            # Workspace is gone (e.g. deleted in Control Hub), drop the cached ID and look it up again
+            print(f"Workspace {workspace_id} not found. Resolving {workspace_name} again.")
+            get_workspace_cache(self.admin.org_id).delete(workspace_name)
+            workspaces.get_index(self.admin.org_id).remove(workspace_name)
+            workspace_id = await self.get_workspace_id(workspace_name)
+            if workspace_id == "":
+                return ""
+            response = await self.post_activation_code(workspace_id, model)
+        if response is None:
             return ""
-        if helper.is_json(response):
-            activation_code = json.loads(response.content)["code"]
+        if helper.is_json(response) and "code" in response.json().keys():
+            activation_code = response.json()["code"]
+            code_cache.set((workspace_name, model), (activation_code, time.time()))
             return activation_code
         else:
             print(f"Something went wrong. Response: {helper.load_text(response)}")
             return ""
 
-    def save(self):
-        data = {
-            "admin_token": self.my_token,
-            "org_id": self.org_id
-        }
-        return data
+    # Gets activation codes for several workspaces, at most BULK_WORKERS at a time.
+    # Returns a dict of workspace name to code, with an empty code for each workspace that failed.
+    async def get_activation_codes(self, workspace_names, model=None) -> dict:
+        if not await self.token_is_valid():
+            return {workspace_name: "" for workspace_name in workspace_names}
+        semaphore = asyncio.Semaphore(BULK_WORKERS)
+
+        async def get_code(workspace_name):
+            async with semaphore:
+                return await self.get_activation_code(workspace_name, model)
+
+        codes = await asyncio.gather(*(get_code(workspace_name) for workspace_name in workspace_names))
+        return dict(zip(workspace_names, codes))
 
+    # Requests an activation code for a workspace ID. Returns None if the request could not be sent.
+    async def post_activation_code(self, workspace_id, model=None):
+        payload = {"workspaceId": workspace_id}
+        if model:
+            payload["model"] = model
+        try:
+            response = await aio.post("devices/activationCode", self.admin.my_token,
+                                      params={"orgId": self.admin.org_id}, data=json.dumps(payload))
+        except aio.ERRORS:
+            return None
+        self.admin.check_response(response)
+        return response
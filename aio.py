@@ -0,0 +1,150 @@
+from __future__ import print_function  # Needed if you want to have console output using Flask
+import asyncio
+import json
+import threading
+import time
+import aiohttp
+from requests.utils import parse_header_links
+import metrics
+import throttle
+import transport
+
+# asyncio side of the Webex transport. One event loop runs in a background thread with one aiohttp session,
+# so hundreds of requests can be in flight without a thread each. Synchronous code hands coroutines to the
+# loop with run() (waits for the result) or submit() (doesn't wait). Requests share the per-token throttle
+# with the synchronous transport.
+loop = None
+session = None
+loop_lock = threading.Lock()
+
+# Errors raised when a request could not be sent or answered
+ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+# Response of an async request, read completely. Quacks like requests.Response where the bot uses it.
+class Response:
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.ok = status_code < 400
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global loop
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="aio", daemon=True).start()
+        return loop
+
+
+# Runs a coroutine on the background loop and waits for its result
+def run(coroutine, timeout=None):
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop()).result(timeout)
+
+
+# Runs a coroutine on the background loop without waiting. Failures are printed.
+def submit(coroutine):
+    future = asyncio.run_coroutine_threadsafe(coroutine, get_loop())
+    future.add_done_callback(report_failure)
+    return future
+
+
+def report_failure(future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Background task failed: {future.exception()!r}")
+
+
+# Closes the session's connections, e.g. on shutdown
+def close() -> None:
+    global session
+    if session is not None:
+        run(session.close(), timeout=5)
+        session = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    global session
+    if session is None:
+        connector = aiohttp.TCPConnector(limit=transport.POOL_SIZE * 5, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(sock_connect=transport.CONNECT_TIMEOUT, sock_read=transport.READ_TIMEOUT)
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return session
+
+
+# Sends a request authorized with the given token. Path is relative to transport.API_URL, or a full URL (e.g.
+# the next page of a listing). Throttled and retried like the synchronous transport: 429s after Retry-After,
+# 5xx on idempotent requests with backoff.
+async def request(method, path, token, **kwargs) -> Response:
+    url = path if path.startswith(("https://", "http://")) else transport.API_URL + path
+    headers = transport.get_headers(token)
+    bucket = throttle.get_bucket(headers["Authorization"], transport.RATE_LIMIT, transport.RATE_BURST)
+    endpoint = metrics.endpoint(path)
+    attempt = 0
+    while True:
+        wait = bucket.reserve()
+        if wait > 0:
+            metrics.throttle_wait_seconds.inc(endpoint, amount=wait)
+            await asyncio.sleep(wait)
+        started_at = time.monotonic()
+        try:
+            async with get_session().request(method, url, headers=headers, **kwargs) as response:
+                result = Response(response.status, response.headers, await response.read())
+        except ERRORS:
+            metrics.observe_request(path, method, None, time.monotonic() - started_at)
+            raise
+        metrics.observe_request(path, method, result.status_code, time.monotonic() - started_at)
+        if attempt >= transport.RETRIES:
+            return result
+        if result.status_code == 429:
+            wait = throttle.retry_after(result.headers)
+            print(f"Rate limited on {path}. Retrying in {wait:.1f}s.")
+            metrics.api_retries.inc(endpoint, method, "429")
+            bucket.pause(wait)
+        elif result.status_code >= 500 and method in transport.IDEMPOTENT_METHODS:
+            wait = throttle.backoff(attempt)
+            print(f"Server error {result.status_code} on {path}. Retrying in {wait:.1f}s.")
+            metrics.api_retries.inc(endpoint, method, "5xx")
+            await asyncio.sleep(wait)
+        else:
+            return result
+        attempt += 1
+
+
+async def get(path, token, **kwargs) -> Response:
+    return await request("GET", path, token, **kwargs)
+
+
+async def post(path, token, **kwargs) -> Response:
+    return await request("POST", path, token, **kwargs)
+
+
+# Items of a listing with the given parameters, following its pages (Link header). Returns None if a
+# request failed.
+async def list_items(path, token, params=None):
+    items = []
+    what = path
+    while path:
+        try:
+            response = await get(path, token, params=params)
+        except ERRORS as e:
+            print(f"Could not list {what}: {e!r}")
+            return None
+        if not response.ok:
+            print(f"Could not list {what}. Response: {response.content[:200]}")
+            return None
+        try:
+            items.extend(response.json().get("items", []))
+        except (ValueError, AttributeError):
+            print(f"Could not list {what}. Response is not a listing: {response.content[:200]}")
+            return None
+        # the next page's URL carries the parameters already
+        links = parse_header_links(response.headers.get("Link", ""))
+        path = next((link["url"] for link in links if link.get("rel") == "next"), None)
+        params = None
+    return items
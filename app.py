@@ -2,103 +2,256 @@ from __future__ import print_function  # Needed if you want to have console outp
 import yaml, json
 from flask import *
 from bot import Bot
+from dispatcher import Dispatcher
+from scheduler import TokenScheduler
+from store import open_store, import_json
+from cache import TTLCache
+import aio
+import metrics
+import sharding
+import atexit
+import hmac
 import os
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 
-app = Flask(__name__)
+routes = Blueprint("routes", __name__)
 
+# routes receiving webhooks, forwarded to the node owning the room in a sharded deployment
+WEBHOOK_ROUTES = {"routes.mention", "routes.card", "routes.added", "routes.removed"}
+CLUSTER_SECRET = os.environ.get("CLUSTER_SECRET")  # needed to change the cluster's nodes through /cluster
 
-@app.route("/", methods=['GET'])
+
+def get_bot() -> Bot:
+    return current_app.extensions["bot"]
+
+
+@routes.route("/", methods=['GET'])
 def index():
     return render_template('index.html')
 
 
+# Returns the webhook's data section, or None if the payload is not a usable webhook event
+def get_event_data():
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get("data"), dict):
+        return None
+    data = payload["data"]
+    if "roomId" not in data or "personId" not in data:
+        return None
+    return data
+
+
+# Forwards a webhook to the node owning its room (see sharding.py) and answers Webex with the owner's answer.
+# Webhooks forwarded by another node are handled here in any case, so a webhook is never forwarded twice,
+# and so are webhooks whose owner can't be reached: the room's state is in the shared store. The owner is
+# looked up in the state in memory, which doesn't wait for the store; a room this node doesn't know the org
+# of yet goes by its ID, and the node handling it loads the state before it does.
+@routes.before_request
+def forward_to_owner():
+    cluster = get_bot().cluster
+    if not cluster.enabled or request.endpoint not in WEBHOOK_ROUTES or request.headers.get(sharding.FORWARDED_HEADER):
+        return None
+    data = get_event_data()
+    if data is None:
+        return None
+    # rooms go by their org, a room not initialized yet by its own ID
+    owner = cluster.owner(data["roomId"], get_bot().room_to_org.get(data["roomId"]))
+    if owner == cluster.self_url:
+        return None
+    answer = cluster.forward(owner, request.path, request.get_data(), {"Content-Type": request.content_type})
+    if answer is None:
+        metrics.shard_forward_failures.inc(owner)
+        return None
+    metrics.shard_forwarded.inc(owner)
+    return answer
+
+
+# Hands the event over to the dispatcher so Webex gets its response right away. Events that were
+# delivered before, to this process or another one sharing the store, are acknowledged without handling
+# them again.
+def dispatch(room_id, handler, *args):
+    payload = request.get_json(silent=True)
+    event_id = payload["data"].get("id")
+    event_key = f"event:{payload.get('resource')}:{payload.get('event')}:{event_id}"
+    seen_events = current_app.extensions["seen_events"]
+    store = get_bot().store
+    if event_id is not None and (not seen_events.add(event_key) or not store.claim(event_key, seen_events.ttl)):
+        print(f"Dropping duplicate delivery of {payload.get('resource')} event {event_id}.")
+        return 'success'
+    if current_app.extensions["dispatcher"].submit(room_id, handler, *args):
+        return 'success'
+    # not queued, so a redelivery must be handled
+    seen_events.delete(event_key)
+    store.release(event_key)
+    return 'busy', 503
+
+
 # Bot mentioned -> Send adaptive card and handle special commands
-@app.route("/mention", methods=['POST'])
+@routes.route("/mention", methods=['POST'])
 def mention():
-    payload = request.get_json()
-    person_id = payload["data"]["personId"]
+    bot = get_bot()
+    data = get_event_data()
+    if data is None or "id" not in data:
+        return 'bad request', 400
+    person_id = data["personId"]
 
     # Ignore own bot messages
     if person_id == bot.id:
         return 'success'
 
-    message_id = payload["data"]["id"]
-    room_id = payload["data"]["roomId"]
-
-    # Load message
-    message = bot.api.messages.get(message_id)
+    # Remember who wrote, saves a lookup if they are added or removed later
+    bot.people.remember(data["roomId"], person_id, data.get("personEmail"))
 
-    # Handle the message
-    bot.handle_command(message.text, room_id, person_id)
+    message_id = data["id"]
+    room_id = data["roomId"]
 
-    return 'success'
+    # Load and handle the message
+    return dispatch(room_id, bot.handle_mention, message_id, room_id, person_id)
 
 
 # Adaptive Card submitted -> Get and return activation code
-@app.route("/card", methods=['POST'])
+@routes.route("/card", methods=['POST'])
 def card():
-    payload = request.get_json()
-    person_id = payload["data"]["personId"]
+    bot = get_bot()
+    data = get_event_data()
+    if data is None or "id" not in data:
+        return 'bad request', 400
+    person_id = data["personId"]
 
-    room_id = payload["data"]["roomId"]
-    attachment_id = payload["data"]["id"]
+    room_id = data["roomId"]
+    attachment_id = data["id"]
 
     # Handle the message
-    bot.handle_card(attachment_id, room_id, person_id)
-
-    return 'success'
+    return dispatch(room_id, bot.handle_card, attachment_id, room_id, person_id)
 
 
-@app.route("/added", methods=['POST'])
+@routes.route("/added", methods=['POST'])
 def added():
-    payload = request.get_json()
-    person_id = payload["data"]["personId"]
+    bot = get_bot()
+    data = get_event_data()
+    if data is None:
+        return 'bad request', 400
 
-    room_id = payload["data"]["roomId"]
+    room_id = data["roomId"]
 
     # Handle the message
-    bot.handle_added(room_id)
+    return dispatch(room_id, bot.handle_added, room_id)
 
-    return 'success'
 
-
-@app.route("/removed", methods=['POST'])
+@routes.route("/removed", methods=['POST'])
 def removed():
-    payload = request.get_json()
-    person_id = payload["data"]["personId"]
+    bot = get_bot()
+    data = get_event_data()
+    if data is None:
+        return 'bad request', 400
 
-    room_id = payload["data"]["roomId"]
+    room_id = data["roomId"]
 
     # Handle the message
-    bot.handle_removed(room_id)
+    return dispatch(room_id, bot.handle_removed, room_id)
 
-    return 'success'
 
+# Queue depth and handling latency of the dispatcher
+@routes.route("/queue", methods=['GET'])
+def queue_stats():
+    return jsonify(current_app.extensions["dispatcher"].stats())
 
-if __name__ == "__main__":
 
+# The cluster's nodes and how many rooms this node owns. Nodes join or leave with a POST of
+# {"join": url}, {"leave": url} or {"nodes": [urls]}, authorized by the X-Cluster-Secret header, and the
+# other nodes are told to reload them ({"reload": true}). With a SQLite store, nodes not on this host are
+# refused, they could not share it.
+@routes.route("/cluster", methods=['GET', 'POST'])
+def cluster_nodes():
+    bot = get_bot()
+    if request.method == 'POST':
+        if not CLUSTER_SECRET or not hmac.compare_digest(request.headers.get("X-Cluster-Secret", ""), CLUSTER_SECRET):
+            return 'forbidden', 403
+        change = request.get_json(silent=True)
+        if not isinstance(change, dict):
+            return 'bad request', 400
+        if change.get("reload"):
+            bot.rebalance()  # changed through another node
+        else:
+            error = change_nodes(bot, change)
+            if error:
+                return error, 400
+    return jsonify({"self": bot.cluster.self_url, "nodes": bot.cluster.nodes,
+                    "rooms": len(bot.admin_data), "owned_rooms": len(bot.room_to_admin)})
+
+
+# Saves the nodes after a change posted to /cluster, takes them on and tells the other nodes. Returns an
+# error message if the nodes are refused.
+def change_nodes(bot, change):
+    old_nodes = set(bot.cluster.nodes)
+    nodes = set(old_nodes)
+    if isinstance(change.get("nodes"), list):
+        nodes = set(change["nodes"])
+    if change.get("join"):
+        nodes.add(change["join"])
+    if change.get("leave"):
+        nodes.discard(change["leave"])
     try:
-        with open("bot_data.json") as file:
-            data = json.load(file)
-    except:
-        data = {
-            "bot_name": os.environ.get("BOT_NAME"),
-            "bot_token": os.environ.get("BOT_TOKEN"),
-            "bot_email": os.environ.get("BOT_EMAIL"),
-            "orgs": [],
-            "admin_data": {},
-            "org_allowed_users": {},
-            "room_to_org": {},
-            "org_id_to_email": {}
-        }
-
-    bot = Bot(data)
+        bot.cluster.check(nodes)
+    except ValueError as e:
+        return str(e)
+    bot.store.save_setting(sharding.NODES_SETTING, json.dumps(sorted(nodes)))
+    bot.rebalance()
+    bot.cluster.announce(old_nodes | nodes, CLUSTER_SECRET)
+    return None
+
+
+# Handler and Webex API latencies, errors and retries in Prometheus text format
+@routes.route("/metrics", methods=['GET'])
+def metrics_text():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+# Loads the bot's state from the store, importing an old bot_data.json first.
+# Bot details not in the store yet are taken from the environment.
+def load_data(store) -> dict:
+    import_json(store)
+    data = store.load()
+    for key in ("bot_name", "bot_token", "bot_email"):
+        if not data[key]:
+            data[key] = os.environ.get(key.upper())
+            store.save_setting(key, data[key])
+    return data
+
+
+def shutdown(dispatcher, scheduler, bot) -> None:
+    scheduler.stop(timeout=5)
+    dispatcher.stop(timeout=float(os.environ.get("SHUTDOWN_TIMEOUT", 10)))
+    bot.outbox.drain(timeout=5)
+    aio.close()
+    bot.teardown()
+
+
+# Application factory. Every process serving the app (e.g. each gunicorn worker) gets its own bot and
+# dispatcher; they share their state through the store.
+def create_app() -> Flask:
+    store = open_store(os.environ.get("BOT_STORE", "bot_data.db"))
+    bot = Bot(load_data(store), store)
     print("Starting bot")
     bot.startup()
-    try:
-        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
-        app.run(host="0.0.0.0", port=os.environ.get("BOT_PORT"))
-    finally:
-        bot.teardown()
+    dispatcher = Dispatcher(workers=int(os.environ.get("BOT_WORKERS", 4)),
+                            max_queue=int(os.environ.get("BOT_QUEUE_SIZE", 1000)))
+    dispatcher.start()
+    # checks tokens in the background, so provisioning doesn't have to
+    scheduler = TokenScheduler(bot)
+    scheduler.start()
+    atexit.register(shutdown, dispatcher, scheduler, bot)
+
+    app = Flask(__name__)
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
+    app.extensions["bot"] = bot
+    app.extensions["dispatcher"] = dispatcher
+    # events handled recently, Webex redelivers an event if it thinks the first delivery failed
+    app.extensions["seen_events"] = TTLCache(maxsize=10000, ttl=int(os.environ.get("EVENT_DEDUP_TTL", 600)))
+    app.register_blueprint(routes)
+    return app
+
+
+if __name__ == "__main__":
+    create_app().run(host="0.0.0.0", port=os.environ.get("BOT_PORT"))
@@ -0,0 +1,95 @@
+import threading
+
+
+# Index of the users allowed to use the bot for each organization. Backed by sets and dicts, so permission
+# checks cost the same no matter how many users an org has. Changes replace an org's sets and dicts with
+# changed copies instead of changing them in place, so permission checks read them without a lock while
+# users are added or removed.
+class AuthIndex:
+
+    def __init__(self, org_allowed_users=None, org_id_to_email=None):
+        self.org_users = {}  # org -> frozenset of allowed user IDs
+        self.user_orgs = {}  # user ID -> frozenset of orgs the user is allowed for
+        self.org_emails = {}  # org -> user ID -> email
+        self.org_email_ids = {}  # org -> email (lower case) -> user ID
+        self.lock = threading.Lock()  # serializes changes, readers don't take it
+        for org_id, user_ids in (org_allowed_users or {}).items():
+            emails = (org_id_to_email or {}).get(org_id, {})
+            self.add_many(org_id, [(user_id, emails.get(user_id, "")) for user_id in user_ids])
+
+    def has_org(self, org_id) -> bool:
+        return org_id in self.org_users
+
+    def is_allowed(self, org_id, user_id) -> bool:
+        return user_id in self.org_users.get(org_id, ())
+
+    def orgs_of(self, user_id) -> frozenset:
+        return self.user_orgs.get(user_id, frozenset())
+
+    # Email of a user of the org, or the user ID if the email is unknown
+    def get_email(self, org_id, user_id) -> str:
+        return self.org_emails.get(org_id, {}).get(user_id) or user_id
+
+    # ID of an allowed user of the org by email, empty if unknown
+    def get_id(self, org_id, email) -> str:
+        return self.org_email_ids.get(org_id, {}).get(email.lower(), "")
+
+    # Allows a user for an org. Returns False if the user was allowed already.
+    def add(self, org_id, user_id, email="") -> bool:
+        return bool(self.add_many(org_id, [(user_id, email)]))
+
+    # Allows (user ID, email) pairs for an org. Returns the users that were newly allowed.
+    def add_many(self, org_id, users) -> list:
+        with self.lock:
+            org_users = set(self.org_users.get(org_id, ()))
+            emails = dict(self.org_emails.get(org_id, {}))
+            email_ids = dict(self.org_email_ids.get(org_id, {}))
+            added = []
+            for user_id, email in users:
+                if email:
+                    emails[user_id] = email
+                    email_ids[email.lower()] = user_id
+                if user_id not in org_users:
+                    org_users.add(user_id)
+                    added.append(user_id)
+            # emails first, so an allowed user always has their email
+            self.org_emails[org_id] = emails
+            self.org_email_ids[org_id] = email_ids
+            self.org_users[org_id] = frozenset(org_users)
+            for user_id in added:
+                self.user_orgs[user_id] = self.user_orgs.get(user_id, frozenset()) | {org_id}
+            return added
+
+    # Removes a user from an org. Returns False if the user wasn't allowed.
+    def remove(self, org_id, user_id) -> bool:
+        return bool(self.remove_many(org_id, [user_id]))
+
+    # Returns the users that were removed
+    def remove_many(self, org_id, user_ids) -> list:
+        with self.lock:
+            org_users = set(self.org_users.get(org_id, ()))
+            removed = [user_id for user_id in dict.fromkeys(user_ids) if user_id in org_users]
+            if not removed:
+                return removed
+            org_users.difference_update(removed)
+            emails = dict(self.org_emails.get(org_id, {}))
+            email_ids = dict(self.org_email_ids.get(org_id, {}))
+            for user_id in removed:
+                email = emails.pop(user_id, "")
+                if email:
+                    email_ids.pop(email.lower(), None)
+                orgs = self.user_orgs.get(user_id, frozenset()) - {org_id}
+                if orgs:
+                    self.user_orgs[user_id] = orgs
+                else:
+                    self.user_orgs.pop(user_id, None)
+            self.org_users[org_id] = frozenset(org_users)
+            self.org_emails[org_id] = emails
+            self.org_email_ids[org_id] = email_ids
+            return removed
+
+    # The index in the format of bot_data.json: org -> list of user IDs, and org -> user ID -> email
+    def to_data(self) -> tuple:
+        org_allowed_users = {org_id: sorted(users) for org_id, users in list(self.org_users.items())}
+        org_id_to_email = {org_id: dict(emails) for org_id, emails in list(self.org_emails.items())}
+        return org_allowed_users, org_id_to_email
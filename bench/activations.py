@@ -0,0 +1,82 @@
+# Measures what tracking device activations (tracker.py) costs against the fake Webex API (fake_webex.py).
+# Codes are issued for many workspaces in a few orgs, and the fake activates a device for each of them a while
+# later. Reports the device listings needed until every room was told, which should grow with the orgs and
+# not with the codes, e.g.:
+#   python bench/activations.py --orgs 3 --codes 50 --activation-delay 2
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_webex import FakeWebex  # noqa: E402
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Device listings needed to confirm activations")
+    parser.add_argument("--orgs", type=int, default=3)
+    parser.add_argument("--codes", type=int, default=50, help="codes issued per org")
+    parser.add_argument("--activation-delay", type=float, default=2, help="seconds until a device activates")
+    parser.add_argument("--poll-min", type=float, default=0.5)
+    parser.add_argument("--poll-max", type=float, default=4)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    fake = FakeWebex()
+    fake.activation_delay = args.activation_delay
+    confirmations = []
+    done = threading.Event()
+    expected = args.orgs * args.codes
+
+    def on_message(message):
+        confirmations.extend([time.monotonic()] * (message.get("text") or "").count("is now activated"))
+        if len(confirmations) >= expected:
+            done.set()
+
+    fake.message_listeners.append(on_message)
+    os.environ.update({"WEBEX_API_URL": fake.start(), "RATE_LIMIT": "1000", "RATE_BURST": "1000",
+                       "ACTIVATION_POLL_MIN": str(args.poll_min), "ACTIVATION_POLL_MAX": str(args.poll_max)})
+    import aio
+    from bot import Bot
+    from store import open_store
+
+    store = open_store(os.path.join(tempfile.mkdtemp(), "activations.db"))
+    data = store.load()
+    data.update({"bot_name": "Bench", "bot_token": "bench-bot-token", "bot_email": "bench@webex.bot"})
+    bot = Bot(data, store)
+    rooms = []
+    for org in range(args.orgs):
+        room_id = f"bench-room-{org}"
+        fake.add_member(room_id, f"bench-person-{org}", f"bench-person-{org}@example.com")
+        rooms.append((bot.init_org(f"bench-org-{org}", f"token-bench-org-{org}", room_id, f"bench-person-{org}"),
+                      room_id))
+
+    fake.reset_calls()
+    started_at = time.monotonic()
+    for admin, room_id in rooms:
+        # issued in batches, like several provision commands
+        for start in range(0, args.codes, 10):
+            names = [f"Bench-{number}" for number in range(start, min(start + 10, args.codes))]
+            aio.run(bot.provision(admin, room_id, names, create_new=True))
+    issued_at = time.monotonic()
+    done.wait(args.timeout)
+    calls = fake.reset_calls()
+
+    print(f"{len(confirmations)} of {expected} activations confirmed, {args.orgs} orgs with {args.codes} codes each")
+    if confirmations:
+        print(f"last confirmation {max(confirmations) - issued_at:.1f}s after the last code, "
+              f"devices activated {args.activation_delay:.1f}s after their code")
+    print(f"device listings: {calls['GET devices']} ({calls['GET devices'] / max(1, expected):.3f} per code), "
+          f"activation codes: {calls['POST devices/activationCode']}, in {time.monotonic() - started_at:.1f}s")
+    bot.outbox.drain(5)
+    aio.close()
+    bot.teardown()
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# Runs a sharded deployment locally: several app.py processes sharing one store, with the fake Webex API
+# (fake_webex.py) in this process. Webhooks all go to the first node, which forwards them to the node owning
+# their room. Halfway through the provisioning, another node joins through /cluster; every provisioning must
+# still be answered. Reports how many rooms each node owns and how many webhooks were forwarded, e.g.:
+#   python bench/cluster.py --nodes 3 --rooms 30 --orgs 10 --provisions 300
+# With --remote-store the nodes share the store through store_server.py, as nodes on several machines would.
+import argparse
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_webex import FakeWebex  # noqa: E402
+from offline import Replies, webhook, BOT_TOKEN, BOT_NAME  # noqa: E402
+from sharding import HashRing  # noqa: E402
+
+CLUSTER_SECRET = "bench-cluster-secret"
+STORE_SECRET = "bench-store-secret"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Starts one node. Its output goes to a log file next to the store.
+def start_node(url, nodes, environment, directory) -> subprocess.Popen:
+    port = url.rsplit(":", 1)[1]
+    log = open(os.path.join(directory, f"node-{port}.log"), "w")
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, "app.py")], cwd=ROOT, stdout=log,
+                            stderr=subprocess.STDOUT,
+                            env=dict(environment, BOT_PORT=port, SHARD_SELF=url, SHARD_NODES=",".join(nodes)))
+
+
+# Starts store_server.py serving a store in directory. Returns the process and the URL to use as BOT_STORE.
+def start_store_server(environment, directory) -> tuple:
+    port = free_port()
+    log = open(os.path.join(directory, "store-server.log"), "w")
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "store_server.py")], cwd=ROOT, stdout=log,
+                               stderr=subprocess.STDOUT, env=dict(environment, STORE_PORT=str(port)))
+    url = f"http://127.0.0.1:{port}"
+    wait_ready(url, path="/call", accept=(405,))
+    return process, url
+
+
+def wait_ready(url, timeout=60, path="/cluster", accept=()) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = requests.get(url + path, timeout=1)
+            if response.ok or response.status_code in accept:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"Node {url} did not start")
+
+
+def forwarded(url) -> int:
+    text = requests.get(url + "/metrics", timeout=5).text
+    return sum(int(float(value)) for value in re.findall(r"^bot_shard_forwarded_total\{[^}]*\} (\S+)$", text, re.M))
+
+
+def print_nodes(urls) -> None:
+    for url in urls:
+        state = requests.get(url + "/cluster", timeout=5).json()
+        print(f"  {url}: owns {state['owned_rooms']} of {state['rooms']} rooms, forwarded {forwarded(url)} webhooks")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local sharded deployment with a node joining under load")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--rooms", type=int, default=30)
+    parser.add_argument("--orgs", type=int, default=10, help="orgs the rooms belong to, rooms are sharded by org")
+    parser.add_argument("--provisions", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the fake API takes per call")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--remote-store", action="store_true", help="share the store through store_server.py")
+    args = parser.parse_args()
+
+    fake = FakeWebex(args.latency, 0.0)
+    replies = Replies()
+    fake.message_listeners.append(replies.on_message)
+    directory = tempfile.mkdtemp()
+    environment = dict(os.environ, WEBEX_API_URL=fake.start(), BOT_STORE=os.path.join(directory, "cluster.db"),
+                       BOT_TOKEN=BOT_TOKEN, BOT_NAME=BOT_NAME, BOT_EMAIL="bench@webex.bot",
+                       CLUSTER_SECRET=CLUSTER_SECRET, RATE_LIMIT="1000", RATE_BURST="1000", PYTHONUNBUFFERED="1")
+    environment.pop("BOT_URL", None)
+    processes = []
+    if args.remote_store:
+        environment["STORE_SECRET"] = STORE_SECRET
+        server, environment["BOT_STORE"] = start_store_server(environment, directory)
+        processes.append(server)
+    urls = [f"http://127.0.0.1:{free_port()}" for _ in range(args.nodes + 1)]
+    nodes, joiner = urls[:-1], urls[-1]
+    processes += [start_node(url, nodes, environment, directory) for url in nodes]
+    try:
+        for url in nodes:
+            wait_ready(url)
+        front = nodes[0]
+        session = requests.Session()
+
+        def post(route, body):
+            response = session.post(front + route, data=body, headers={"Content-Type": "application/json"})
+            return response.status_code
+
+        rooms = [(f"bench-room-{number}", f"bench-person-{number}", f"bench-org-{number % args.orgs}")
+                 for number in range(args.rooms)]
+        for room_id, person_id, org_id in rooms:
+            fake.add_member(room_id, person_id, f"{person_id}@example.com")
+            action_id = fake.add_attachment_action(room_id, person_id, {"org_id": org_id,
+                                                                        "access_token": f"token-{org_id}"})
+            post("/card", webhook("attachmentActions", "created",
+                                  {"id": action_id, "roomId": room_id, "personId": person_id}))
+        deadline = time.monotonic() + args.timeout
+        while len(replies.initialized) < len(rooms) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        print(f"Initialized {len(replies.initialized)} of {len(rooms)} rooms on {len(nodes)} nodes.")
+
+        events = []
+        for number in range(args.provisions):
+            room_id, person_id, org_id = rooms[number % len(rooms)]
+            action_id = fake.add_attachment_action(room_id, person_id, {"workspace": f"Bench-{number}"})
+            events.append((room_id, webhook("attachmentActions", "created",
+                                            {"id": action_id, "roomId": room_id, "personId": person_id})))
+        replies.expected = len(events)
+
+        def send(event):
+            room_id, body = event
+            replies.expect(room_id, time.monotonic())
+            return post("/card", body)
+
+        # a node joins while the first half of the provisioning is in flight
+        half = len(events) // 2
+        started_at = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            statuses = list(executor.map(send, events[:half]))
+            processes.append(start_node(joiner, nodes + [joiner], environment, directory))
+            wait_ready(joiner)
+            requests.post(front + "/cluster", json={"join": joiner}, headers={"X-Cluster-Secret": CLUSTER_SECRET},
+                          timeout=10).raise_for_status()
+            statuses += list(executor.map(send, events[half:]))
+        while not replies.done.wait(0.1) and time.monotonic() < deadline:
+            pass
+        elapsed = time.monotonic() - started_at
+
+        before, after = HashRing(nodes), HashRing(nodes + [joiner])
+        moved = sum(before.node_for(org_id) != after.node_for(org_id) for room_id, person_id, org_id in rooms)
+        print(f"{len(replies.latencies)} of {len(events)} provisionings answered in {elapsed:.2f}s "
+              f"({replies.failed} failed, {sum(status != 200 for status in statuses)} webhooks not accepted)")
+        print(f"{moved} of {len(rooms)} rooms moved to the node that joined.")
+        print_nodes(nodes + [joiner])
+        print(json.dumps(requests.get(joiner + "/cluster", timeout=5).json()))
+        if len(replies.latencies) < len(events):
+            print(f"Lost provisionings, see the node logs in {directory}")
+            sys.exit(1)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(10)
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
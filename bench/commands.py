@@ -0,0 +1,52 @@
+# Measures what finding the command of a mention costs as the number of commands grows, for the command
+# router (commands.py) and, for comparison, an if/elif chain like handle_command used to be. E.g.:
+#   python bench/commands.py --commands 5 50 500
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from commands import Router  # noqa: E402
+
+MESSAGE = "Bench provision Room-{1..40}, Lobby"
+
+
+def make_router(count) -> Router:
+    router = Router()
+    for number in range(count - 1):
+        router.command(f"command{number}", aliases=(f"alias{number}",))(lambda bot, invocation: None)
+    router.command("provision", min_args=1)(lambda bot, invocation: None)
+    return router
+
+
+# The words are checked one command after another, the last one matching
+def make_chain(count):
+    names = [f"command{number}" for number in range(count - 1)] + ["provision"]
+
+    def chain(message):
+        for name in names:
+            if len(message.split()) > 2 and message.split()[1] == name:
+                return name
+        return None
+    return chain
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Cost of command dispatch by number of commands")
+    parser.add_argument("--commands", type=int, nargs="+", default=[5, 50, 500])
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'commands':>9} {'router':>12} {'if/elif':>12}")
+    for count in args.commands:
+        router = make_router(count)
+        chain = make_chain(count)
+        routed = timeit.timeit(lambda: router.match(MESSAGE.split()[1:]), number=args.number) / args.number
+        chained = timeit.timeit(lambda: chain(MESSAGE), number=args.number) / args.number
+        print(f"{count:>9} {routed * 1e6:>9.2f} us {chained * 1e6:>9.2f} us")
+
+
+if __name__ == "__main__":
+    main()
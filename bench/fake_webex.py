@@ -0,0 +1,261 @@
+# Local stand-in for the parts of the Webex API the bot uses, for benchmarks without webexapis.com.
+# Serves people/me, workspaces, devices (and activationCode), memberships, messages, attachment/actions and
+# webhooks under /v1/, with configurable latency and injected 5xx errors and 429s. Counts every call.
+# Run standalone with: python bench/fake_webex.py --port 8765 (then WEBEX_API_URL=http://127.0.0.1:8765/v1/)
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+
+class FakeWebex:
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after=1):
+        self.latency = latency  # seconds added to every call
+        self.jitter = jitter  # up to this many seconds more, at random
+        self.error_rate = error_rate  # share of calls answered with 503
+        self.rate_limit_rate = rate_limit_rate  # share of calls answered with 429
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.calls = Counter()  # "METHOD resource" -> number of calls
+        self.workspaces = {}  # id -> workspace
+        self.devices = {}  # id -> device
+        self.activation_delay = None  # if set, a device activates this many seconds after its code was issued
+        self.memberships = []
+        self.messages = {}  # id -> message
+        self.attachment_actions = {}
+        self.webhooks = {}
+        self.invalid_tokens = set()
+        self.message_listeners = []  # called with each message posted
+        self.server = None
+        self.base_url = None
+
+    # Starts serving in a background thread. Returns the base URL to use as WEBEX_API_URL.
+    def start(self, port=0) -> str:
+        fake = self
+
+        class Handler(FakeHandler):
+            webex = fake
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake-webex", daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}/v1/"
+        return self.base_url
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def reset_calls(self) -> Counter:
+        with self.lock:
+            calls = self.calls
+            self.calls = Counter()
+            return calls
+
+    def add_member(self, room_id, person_id, email) -> None:
+        with self.lock:
+            self.memberships.append({"id": str(uuid.uuid4()), "roomId": room_id, "personId": person_id,
+                                     "personEmail": email})
+
+    def add_message(self, room_id, person_id, text) -> str:
+        message_id = str(uuid.uuid4())
+        with self.lock:
+            self.messages[message_id] = {"id": message_id, "roomId": room_id, "personId": person_id, "text": text}
+        return message_id
+
+    def add_workspace(self, org_id, name) -> str:
+        workspace = {"id": str(uuid.uuid4()), "displayName": name, "orgId": org_id}
+        with self.lock:
+            self.workspaces[workspace["id"]] = workspace
+        return workspace["id"]
+
+    # A device activated with a code, in the workspace
+    def add_device(self, workspace_id) -> str:
+        with self.lock:
+            workspace = self.workspaces[workspace_id]
+            device = {"id": str(uuid.uuid4()), "displayName": f"Board in {workspace['displayName']}",
+                      "workspaceId": workspace_id, "orgId": workspace["orgId"], "product": "Cisco Webex Board",
+                      "connectionStatus": "connected",
+                      "created": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())}
+            self.devices[device["id"]] = device
+        return device["id"]
+
+    def add_attachment_action(self, room_id, person_id, inputs) -> str:
+        action_id = str(uuid.uuid4())
+        with self.lock:
+            self.attachment_actions[action_id] = {"id": action_id, "type": "submit", "roomId": room_id,
+                                                  "personId": person_id, "inputs": inputs}
+        return action_id
+
+    # Returns (status, body, headers) for a request
+    def handle(self, method, path, query, body, token):
+        parts = [part for part in path.split("/") if part][1:]  # drop "v1"
+        # calls are counted by resource, without IDs: "GET messages", "POST devices/activationCode"
+        resource = "/".join(parts[:2] if parts and parts[0] in ("attachment", "devices") else parts[:1])
+        with self.lock:
+            self.calls[f"{method} {resource}"] += 1
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if random.random() < self.rate_limit_rate:
+            return 429, {"message": "Too many requests"}, {"Retry-After": str(self.retry_after)}
+        if random.random() < self.error_rate:
+            return 503, {"message": "Service unavailable"}, {}
+        if token in self.invalid_tokens:
+            return 401, {"message": "The request requires a valid access token."}, {}
+        route = getattr(self, f"{method.lower()}_{parts[0].replace('-', '_')}" if parts else "", None)
+        if route is None:
+            return 404, {"message": "Not found"}, {}
+        return route(parts[1:], query, body, token)
+
+    def get_people(self, parts, query, body, token):
+        return 200, {"id": "person-" + token[:12], "emails": [token[:12] + "@example.com"]}, {}
+
+    def get_workspaces(self, parts, query, body, token):
+        with self.lock:
+            items = [workspace for workspace in self.workspaces.values() if workspace["orgId"] == query.get("orgId")
+                     and query.get("displayName") in (None, workspace["displayName"])]
+        # paginated like the real API, with a Link header to the next page
+        start, size = int(query.get("start", 0)), int(query.get("max", 100))
+        headers = {}
+        if start + size < len(items):
+            headers["Link"] = f'<{self.base_url}workspaces?{urlencode(dict(query, start=start + size))}>; rel="next"'
+        return 200, {"items": items[start:start + size]}, headers
+
+    def post_workspaces(self, parts, query, body, token):
+        workspace = {"id": str(uuid.uuid4()), "displayName": body["displayName"], "orgId": body["orgId"]}
+        with self.lock:
+            self.workspaces[workspace["id"]] = workspace
+        return 200, workspace, {}
+
+    def get_devices(self, parts, query, body, token):
+        with self.lock:
+            items = [device for device in self.devices.values() if device["orgId"] == query.get("orgId")
+                     and query.get("workspaceId") in (None, device["workspaceId"])]
+        start, size = int(query.get("start", 0)), int(query.get("max", 100))
+        headers = {}
+        if start + size < len(items):
+            headers["Link"] = f'<{self.base_url}devices?{urlencode(dict(query, start=start + size))}>; rel="next"'
+        return 200, {"items": items[start:start + size]}, headers
+
+    def post_devices(self, parts, query, body, token):
+        if body.get("workspaceId") not in self.workspaces:
+            return 404, {"message": "Workspace not found"}, {}
+        if self.activation_delay is not None:
+            threading.Timer(self.activation_delay, self.add_device, (body["workspaceId"],)).start()
+        return 200, {"code": "".join(random.choice("0123456789") for _ in range(16))}, {}
+
+    def get_memberships(self, parts, query, body, token):
+        with self.lock:
+            items = [membership for membership in self.memberships if membership["roomId"] == query.get("roomId")
+                     and query.get("personEmail") in (None, membership["personEmail"])
+                     and query.get("personId") in (None, membership["personId"])]
+        return 200, {"items": items}, {}
+
+    def get_messages(self, parts, query, body, token):
+        message = self.messages.get(parts[0]) if parts else None
+        if message is None:
+            return 404, {"message": "Not found"}, {}
+        return 200, message, {}
+
+    def post_messages(self, parts, query, body, token):
+        message = dict(body, id=str(uuid.uuid4()), created=time.time())
+        for listener in self.message_listeners:
+            listener(message)
+        return 200, message, {}
+
+    def get_attachment(self, parts, query, body, token):
+        action = self.attachment_actions.get(parts[-1]) if parts else None
+        if action is None:
+            return 404, {"message": "Not found"}, {}
+        return 200, action, {}
+
+    def get_webhooks(self, parts, query, body, token):
+        with self.lock:
+            return 200, {"items": list(self.webhooks.values())}, {}
+
+    def post_webhooks(self, parts, query, body, token):
+        webhook = dict(body, id=str(uuid.uuid4()), status="active")
+        with self.lock:
+            self.webhooks[webhook["id"]] = webhook
+        return 200, webhook, {}
+
+    def put_webhooks(self, parts, query, body, token):
+        with self.lock:
+            if parts[0] not in self.webhooks:
+                return 404, {"message": "Not found"}, {}
+            self.webhooks[parts[0]].update(body)
+            return 200, self.webhooks[parts[0]], {}
+
+    def delete_webhooks(self, parts, query, body, token):
+        with self.lock:
+            self.webhooks.pop(parts[0], None)
+        return 204, None, {}
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    webex = None  # set on the subclass made by FakeWebex.start()
+
+    def respond(self, method):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length) if length else b""
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError:
+            body = {"multipart": True}  # file uploads, content is not needed
+        token = self.headers.get("Authorization", "").replace("Bearer ", "")
+        status, payload, headers = self.webex.handle(method, url.path, query, body, token)
+        content = b"" if payload is None else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.respond("GET")
+
+    def do_POST(self):
+        self.respond("POST")
+
+    def do_PUT(self):
+        self.respond("PUT")
+
+    def do_DELETE(self):
+        self.respond("DELETE")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local stand-in for the Webex API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    fake = FakeWebex(args.latency, args.jitter, args.error_rate, args.rate_limit_rate)
+    print(f"Serving fake Webex API at {fake.start(args.port)}")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
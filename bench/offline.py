@@ -0,0 +1,178 @@
+# Benchmarks the bot end to end without webexapis.com. Starts the fake Webex API (fake_webex.py) in this
+# process, initializes a number of rooms through the /card route like real users would, then replays
+# provisioning webhooks against app.py's routes and reports, e.g.:
+#   python bench/offline.py --rooms 20 --provisions 500 --latency 0.05 --rate-limit-rate 0.01
+#   - ack latency: time for a route to answer Webex (p50/p99)
+#   - end to end latency: webhook received until the activation code message was posted (p50/p99)
+#   - throughput: provisionings completed per second
+#   - API calls per provisioning, by endpoint
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_webex import FakeWebex  # noqa: E402
+from dispatcher import percentile  # noqa: E402
+
+BOT_TOKEN = "bench-bot-token"
+BOT_NAME = "Bench"
+
+
+# Collects the bot's replies. Each room gets its replies in the order its webhooks were sent, so a reply
+# completes the room's oldest pending provisioning.
+class Replies:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # room ID -> send times of provisionings without reply
+        self.latencies = []
+        self.failed = 0
+        self.initialized = set()
+        self.done = threading.Event()
+        self.expected = 0
+        self.last_reply_at = None
+
+    def expect(self, room_id, sent_at) -> None:
+        with self.lock:
+            self.pending.setdefault(room_id, deque()).append(sent_at)
+
+    def on_message(self, message) -> None:
+        room_id = message.get("roomId")
+        text = message.get("text") or message.get("markdown") or ""
+        # the bot may put several replies into one message
+        replies = [False] * text.count("Here's your activation code") + [True] * text.count("Something went wrong")
+        with self.lock:
+            if "Initialization success" in text:
+                self.initialized.add(room_id)
+            pending = self.pending.get(room_id)
+            now = time.monotonic()
+            for failed in replies:
+                if not pending:
+                    break
+                self.latencies.append(now - pending.popleft())
+                self.failed += failed
+                self.last_reply_at = now
+            if self.expected and len(self.latencies) >= self.expected:
+                self.done.set()
+
+
+# Builds a webhook payload like the ones Webex posts to the bot
+def webhook(resource, event, data) -> str:
+    return json.dumps({"id": "bench-webhook", "resource": resource, "event": event, "data": data})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End to end benchmark against a local fake Webex API")
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--provisions", type=int, default=200)
+    parser.add_argument("--names", type=int, default=0,
+                        help="distinct workspace names per room, repeats show the caches at work (default: all new)")
+    parser.add_argument("--scenario", choices=("card", "mention"), default="card",
+                        help="provision by submitting the card or with a 'provision' mention")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the fake API takes per call")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--metrics", action="store_true", help="print the bot's /metrics after the run")
+    parser.add_argument("--idle", type=float, default=10,
+                        help="stop waiting once no reply came for this many seconds (replies lost to errors)")
+    args = parser.parse_args()
+
+    fake = FakeWebex(args.latency, args.jitter, args.error_rate, args.rate_limit_rate, args.retry_after)
+    replies = Replies()
+    fake.message_listeners.append(replies.on_message)
+    directory = tempfile.mkdtemp()
+    # the bot reads its configuration on import
+    os.environ.update({"WEBEX_API_URL": fake.start(), "BOT_STORE": os.path.join(directory, "bench.db"),
+                       "BOT_TOKEN": BOT_TOKEN, "BOT_NAME": BOT_NAME, "BOT_EMAIL": "bench@webex.bot"})
+    os.environ.setdefault("RATE_LIMIT", "1000")
+    os.environ.setdefault("RATE_BURST", "1000")
+    import app
+
+    flask_app = app.create_app()
+    clients = threading.local()
+
+    def post(route, body):
+        if not hasattr(clients, "client"):
+            clients.client = flask_app.test_client()
+        started_at = time.monotonic()
+        status = clients.client.post(route, data=body, content_type="application/json").status_code
+        return time.monotonic() - started_at, status
+
+    # every room gets an admin of its own org and one allowed user
+    rooms = [(f"bench-room-{number}", f"bench-person-{number}", f"bench-org-{number}") for number in range(args.rooms)]
+    for room_id, person_id, org_id in rooms:
+        fake.add_member(room_id, person_id, f"{person_id}@example.com")
+        action_id = fake.add_attachment_action(room_id, person_id, {"org_id": org_id,
+                                                                    "access_token": f"token-{org_id}"})
+        post("/card", webhook("attachmentActions", "created",
+                              {"id": action_id, "roomId": room_id, "personId": person_id}))
+    deadline = time.monotonic() + args.timeout
+    while len(replies.initialized) < len(rooms) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    print(f"Initialized {len(replies.initialized)} of {len(rooms)} rooms.")
+
+    # the webhooks to replay, spread over the rooms
+    names = args.names or args.provisions
+    events = []
+    for number in range(args.provisions):
+        room_id, person_id, org_id = rooms[number % len(rooms)]
+        workspace_name = f"Bench-{number // len(rooms) % names}"
+        if args.scenario == "card":
+            item_id = fake.add_attachment_action(room_id, person_id, {"workspace": workspace_name})
+            events.append((room_id, "/card", webhook("attachmentActions", "created",
+                                                     {"id": item_id, "roomId": room_id, "personId": person_id})))
+        else:
+            item_id = fake.add_message(room_id, person_id, f"{BOT_NAME} provision {workspace_name}")
+            events.append((room_id, "/mention", webhook("messages", "created",
+                                                        {"id": item_id, "roomId": room_id, "personId": person_id})))
+    replies.expected = len(events)
+    fake.reset_calls()
+
+    def send(event):
+        room_id, route, body = event
+        replies.expect(room_id, time.monotonic())
+        return post(route, body)
+
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        acks = list(executor.map(send, events))
+    while not replies.done.wait(0.1) and time.monotonic() < deadline \
+            and time.monotonic() - (replies.last_reply_at or started_at) < args.idle:
+        pass
+    if not replies.done.is_set():
+        print(f"Gave up with {len(events) - len(replies.latencies)} provisionings unanswered.")
+    elapsed = (replies.last_reply_at or time.monotonic()) - started_at
+    calls = fake.reset_calls()
+
+    ack_times = sorted(ack for ack, status in acks)
+    latencies = sorted(replies.latencies)
+    completed = len(latencies)
+    print(f"\n{completed} of {len(events)} provisionings completed in {elapsed:.2f}s "
+          f"({replies.failed} failed, {sum(status != 200 for ack, status in acks)} webhooks not accepted)")
+    print(f"ack latency         p50 {percentile(ack_times, 50) * 1000:8.1f} ms   "
+          f"p99 {percentile(ack_times, 99) * 1000:8.1f} ms")
+    print(f"end to end latency  p50 {percentile(latencies, 50) * 1000:8.1f} ms   "
+          f"p99 {percentile(latencies, 99) * 1000:8.1f} ms")
+    print(f"throughput          {completed / elapsed if elapsed > 0 else 0:.1f} provisionings/s")
+    print(f"API calls per provisioning: {sum(calls.values()) / max(1, completed):.2f}")
+    for endpoint, count in sorted(calls.items()):
+        print(f"  {endpoint:<32} {count / max(1, completed):6.2f}")
+    if args.metrics:
+        print("\n" + flask_app.test_client().get("/metrics").get_data(as_text=True))
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
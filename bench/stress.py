@@ -0,0 +1,162 @@
+# Stress test of the bot's state under concurrent changes, against the fake Webex API (fake_webex.py). One
+# thread per room keeps (re)initializing its room with one of a few tokens of its org and adding and removing
+# users, like the dispatcher's workers would, while other threads read the state, reload it from the store
+# and drop admins. Afterwards the state in memory and in the store must hold every change, e.g.:
+#   python bench/stress.py --orgs 4 --rooms 8 --users 20 --rounds 30
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_webex import FakeWebex  # noqa: E402
+
+TOKENS_PER_ORG = 3
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Concurrent state changes, checked for lost updates")
+    parser.add_argument("--orgs", type=int, default=4)
+    parser.add_argument("--rooms", type=int, default=8, help="rooms per org")
+    parser.add_argument("--users", type=int, default=20, help="users added and removed per room and round")
+    parser.add_argument("--rounds", type=int, default=30)
+    parser.add_argument("--readers", type=int, default=4)
+    args = parser.parse_args()
+
+    fake = FakeWebex(latency=0.0, jitter=0.0)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "stress.db")
+    os.environ.update({"WEBEX_API_URL": fake.start(), "RATE_LIMIT": "100000", "RATE_BURST": "100000",
+                       "OUTBOX_LINGER": "0"})
+    import aio
+    from bot import Bot
+    from store import open_store
+
+    store = open_store(path)
+    data = store.load()
+    data.update({"bot_name": "Stress", "bot_token": "stress-bot-token", "bot_email": "stress@webex.bot"})
+    bot = Bot(data, store)
+
+    rooms = [(f"org-{org}", f"room-{org}-{room}") for org in range(args.orgs) for room in range(args.rooms)]
+    for org_id, room_id in rooms:
+        fake.add_member(room_id, f"admin-{room_id}", f"admin-{room_id}@example.com")
+        for user in range(args.users):
+            fake.add_member(room_id, f"user-{room_id}-{user}", f"user-{room_id}-{user}@example.com")
+
+    stopped = threading.Event()
+    errors = []
+
+    def guarded(target):
+        def run(*arguments):
+            try:
+                target(*arguments)
+            except Exception as e:
+                errors.append(f"{target.__name__}: {e!r}")
+        return run
+
+    # Each round the room is initialized with one of its org's tokens, its users are added and the odd
+    # ones removed again
+    def change(org_id, room_id):
+        emails = [f"user-{room_id}-{user}@example.com" for user in range(args.users)]
+        for number in range(args.rounds):
+            if not bot.init_org(org_id, f"token-{org_id}-{number % TOKENS_PER_ORG}", room_id, f"admin-{room_id}"):
+                errors.append(f"{room_id} could not be initialized")
+            bot.add_allowed_users(org_id, room_id, emails)
+            bot.remove_allowed_users(org_id, room_id, emails[1::2])
+
+    # Reads the state like the handlers do, iterating it while it changes
+    def read():
+        while not stopped.wait(0.001):
+            for org_id, room_id in rooms:
+                bot.auth.is_allowed(org_id, f"user-{room_id}-0")
+                bot.room_to_org.get(room_id)
+            bot.auth.to_data()
+            sum(1 for admin in bot.room_to_admin.values() if admin.org_id)
+            [bot.rooms_of(admin) for admin in list(bot.admins.values())]
+
+    # Changes the store from another connection, so the bot reloads its state, like with several processes
+    def reload():
+        other = open_store(path)
+        while not stopped.wait(0.01):
+            other.save_setting("bot_name", "Stress")
+            bot.sync()
+        other.close()
+
+    # Drops admins whose token is not the latest of their org, like the token scheduler does for rejected ones
+    def drop():
+        while not stopped.wait(0.005):
+            for admin in list(bot.admins.values()):
+                if not admin.my_token.endswith(f"-{(args.rounds - 1) % TOKENS_PER_ORG}"):
+                    bot.drop_admin(admin)
+
+    started_at = time.monotonic()
+    changers = [threading.Thread(target=guarded(change), args=room) for room in rooms]
+    others = ([threading.Thread(target=guarded(read)) for _ in range(args.readers)]
+              + [threading.Thread(target=guarded(reload)), threading.Thread(target=guarded(drop))])
+    for thread in changers + others:
+        thread.start()
+    for thread in changers:
+        thread.join()
+    stopped.set()
+    for thread in others:
+        thread.join()
+    seconds = time.monotonic() - started_at
+    bot.outbox.drain(10)
+
+    lost = check(bot, store, rooms, args)
+    print(f"{len(rooms)} rooms in {args.orgs} orgs, {args.rounds} rounds: {seconds:.1f}s, "
+          f"{len(rooms) * args.rounds / seconds:.0f} initializations per second")
+    for error in errors[:10]:
+        print(f"error: {error}")
+    for line in lost[:20]:
+        print(f"lost: {line}")
+    print("OK, no lost updates" if not errors and not lost else f"{len(errors)} errors, {len(lost)} lost updates")
+    aio.close()
+    bot.teardown()
+    fake.stop()
+    sys.exit(1 if errors or lost else 0)
+
+
+# Compares the state in memory with what every room should have ended with and with the store
+def check(bot, store, rooms, args) -> list:
+    lost = []
+    expected = defaultdict(set)
+    for org_id, room_id in rooms:
+        expected[org_id].add(f"admin-{room_id}")
+        expected[org_id].update(f"user-{room_id}-{user}" for user in range(0, args.users, 2))
+    allowed, emails = bot.auth.to_data()
+    for org_id, user_ids in expected.items():
+        if set(allowed.get(org_id, ())) != user_ids:
+            lost.append(f"allowed users of {org_id}: {len(user_ids - set(allowed.get(org_id, ())))} missing, "
+                        f"{len(set(allowed.get(org_id, ())) - user_ids)} not removed")
+    stored = store.load()
+    if {org_id: set(users) for org_id, users in stored["org_allowed_users"].items()} != \
+            {org_id: set(users) for org_id, users in allowed.items()}:
+        lost.append("allowed users differ between memory and store")
+    if stored["org_id_to_email"] != emails:
+        lost.append("emails differ between memory and store")
+    if sorted(stored["orgs"]) != sorted(bot.orgs) or len(bot.orgs) != args.orgs:
+        lost.append(f"orgs: {bot.orgs} in memory, {stored['orgs']} in store")
+    for org_id, room_id in rooms:
+        if bot.room_to_org.get(room_id) != org_id or stored["room_to_org"].get(room_id) != org_id:
+            lost.append(f"org of {room_id}")
+        admin = bot.room_to_admin.get(room_id)
+        admin_data = stored["admin_data"].get(room_id)
+        if admin is None or admin_data is None:
+            if (admin is None) != (admin_data is None):
+                lost.append(f"admin of {room_id}: {admin and admin.my_token} in memory, {admin_data} in store")
+        elif admin.my_token != admin_data["admin_token"] or bot.admins.get((org_id, admin.my_token)) is not admin:
+            lost.append(f"token of {room_id}: {admin.my_token} in memory, {admin_data['admin_token']} in store")
+    used = {id(admin) for admin in bot.room_to_admin.values()}
+    if any(id(admin) not in used for admin in bot.admins.values()):
+        lost.append("admins no room uses are kept")
+    return lost
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Measures how many webhooks per second the bot accepts when served by gunicorn with different numbers of
+# worker processes. Run with the bot's environment set (BOT_TOKEN etc.), e.g.:
+#   python bench/throughput.py --workers 1 2 4 --requests 5000
+# Point WEBEX_API_URL at a test server rather than webexapis.com (e.g. python bench/fake_webex.py), the
+# queued events are handled for real (and raise RATE_LIMIT for it, or the workers spend the run waiting on
+# the throttle).
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def card_event(room_id) -> dict:
+    event = {
+        "id": "bench-webhook",
+        "resource": "attachmentActions",
+        "event": "created",
+        "data": {"id": str(uuid.uuid4()), "roomId": room_id, "personId": "bench-person"}
+    }
+    return event
+
+
+def wait_until_up(url, timeout=60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url + "/queue", timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not come up")
+
+
+# Sends requests to url from concurrency threads. Returns accepted webhooks per second.
+def run_load(url, total, concurrency, rooms) -> float:
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    events = [json.dumps(card_event(f"bench-room-{number % rooms}")) for number in range(total)]
+
+    def send(body):
+        return session.post(url + "/card", data=body, headers={"Content-Type": "application/json"}).status_code
+
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        statuses = list(executor.map(send, events))
+    elapsed = time.monotonic() - started_at
+    accepted = statuses.count(200)
+    if accepted != total:
+        print(f"  {total - accepted} of {total} requests not accepted")
+    return accepted / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Webhook throughput by number of gunicorn workers")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--port", type=int, default=8099)
+    args = parser.parse_args()
+
+    url = f"http://127.0.0.1:{args.port}"
+    results = {}
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, BOT_STORE=os.path.join(directory, "bench.db"))
+            server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-w", str(workers), "--threads", "4",
+                                       "-b", f"127.0.0.1:{args.port}", "--chdir", ROOT, "wsgi:app"],
+                                      env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_until_up(url)
+                run_load(url, min(200, args.requests), args.concurrency, args.rooms)  # warm up
+                results[workers] = run_load(url, args.requests, args.concurrency, args.rooms)
+            finally:
+                server.terminate()
+                server.wait()
+        print(f"{workers} workers: {results[workers]:.0f} webhooks/s")
+
+    base = results[args.workers[0]]
+    for workers, rate in results.items():
+        print(f"{workers:>3} workers  {rate:>8.0f} webhooks/s  x{rate / base:.2f}")
+
+
+if __name__ == "__main__":
+    main()
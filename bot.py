@@ -1,126 +1,315 @@
 from __future__ import print_function  # Needed if you want to have console output using Flask
-from webexteamssdk import WebexTeamsAPI, ApiError
-import json
+from concurrent.futures import ThreadPoolExecutor, wait, TimeoutError as FutureTimeoutError
+import asyncio
+import csv
+import os
+import tempfile
+import threading
+import time
+import weakref
+import aio
+import cards
 import helper
+import locks
+import metrics
+import sharding
+import transport
+import webhooks
+import workspaces
+from store import Store
+from auth import AuthIndex
+from people import PersonResolver
+from commands import router, Invocation
+from outbox import Outbox
+from tracker import ActivationTracker
+
+BULK_LIMIT = int(os.environ.get("BULK_LIMIT", 100))  # most workspaces provisioned by one request
+CSV_THRESHOLD = 20  # codes for more workspaces than this are sent as a CSV file
+SUGGESTION_CARDS = 5  # likely typos offered a card each, for more the user is asked to provision again
+WORKSPACE_PICKER_LIMIT = int(os.environ.get("WORKSPACE_PICKER_LIMIT", 100))  # most workspaces offered in the card
+STARTUP_WORKERS = int(os.environ.get("STARTUP_WORKERS", 16))  # parallel token checks on startup
+STARTUP_TIMEOUT = float(os.environ.get("STARTUP_TIMEOUT", 30))  # seconds to wait for them
 
 
 # The entity communicating with the user
 class Bot:
 
-    def __init__(self, data):
-        # read from file
+    def __init__(self, data, store=None, cluster=None):
+        # read from the store
         self.name = data["bot_name"]
         self.email = data["bot_email"]
         self.bot_token = data["bot_token"]
 
-        # handles any API calls using the SDK
-        self.api = WebexTeamsAPI(access_token=self.bot_token)
+        # handles any API calls using the SDK, shares the connection pool with the admins
+        self.api = transport.get_api(self.bot_token)
         self.id = self.api.people.me().id
+        self.people = PersonResolver(self.api)  # cached email <-> ID lookups of room members
 
-        # adaptive cards
-        self.code_card = helper.make_code_card()
-        self.init_card = helper.make_init_card()
+        # adaptive cards, serialized once
+        self.code_card = cards.CardMessage(helper.make_code_card(), text="Here's your card", workspace="")
+        self.init_card = cards.CardMessage(helper.make_init_card(), text="Please initialize")
 
         # will be populated on startup
         self.webhooks = []
 
-        # user populated data, is read from file in app.py and passed on creation
-        # empty data passed if not found in file
-        self.orgs = data["orgs"]  # list of organizations
-        self.org_allowed_users = data["org_allowed_users"]  # list of allowed users for each organization
-        self.org_id_to_email = data["org_id_to_email"]  # list of mappings of ids to emails for users of each organization
-        self.room_to_admin = {}  # maps each room to its admin
-        self.room_to_org = data["room_to_org"]  # maps each room to its current org
+        # sends replies in the background, putting consecutive ones to a room together
+        self.outbox = Outbox(self.bot_token)
 
-        #  create an admin for each known room
-        for room in data["admin_data"].keys():
-            admin = helper.create_admin(data["admin_data"][room]["admin_token"], data["admin_data"][room]["org_id"], self.room_to_org[room])
-            if admin.my_id == "": # if admin fails to get id, should be reinitialized
-                self.reinit(room)
-            else:
-                self.room_to_admin[room] = admin
+        # tells rooms when a device activated with a code they were sent
+        self.tracker = ActivationTracker(self.outbox)
+
+        # serializes provisioning per room on the async client. A room's lock goes away when no provisioning
+        # holds or waits for it.
+        self.provision_locks = weakref.WeakValueDictionary()
+
+        # every change to the user populated data below is written to the store right away
+        self.store = store if store is not None else Store()
+
+        # Changes to the user populated data hold the lock of the room and/or org they change, taken in that
+        # order, and the state lock shared; reloading it from the store takes the state lock exclusive.
+        # The dicts and lists are replaced with changed copies (under maps_lock) instead of being changed in
+        # place, so handlers read them without a lock.
+        self.room_locks = locks.KeyedLocks()
+        self.org_locks = locks.KeyedLocks()
+        self.state = locks.SharedLock()
+        self.maps_lock = threading.Lock()
+
+        # the nodes sharing the orgs' rooms in a sharded deployment, see sharding.py
+        self.cluster = cluster if cluster is not None else sharding.Cluster(
+            local_only=not self.store.shared_across_hosts)
+
+        # user populated data, is loaded from the store in app.py and passed on creation
+        # empty data passed if nothing was stored yet
+        self.admins = {}  # one admin per (org, token), shared by all rooms using that token for that org
+        self.room_to_admin = {}  # maps each room this node owns to its admin
+        self.load(data)
+        self.data_version = self.store.data_version()
 
         self.unauthorized_message = ("You're unauthorized. Please contact the person who initialized the bot if you "
                                      "require access.")
 
-    def startup(self) -> None:
-        webhooks = self.api.webhooks.list()
-        for webhook in webhooks:
-            self.webhooks.append(webhook)
-        if len(self.webhooks) < 4:
-            print("Don't have all webhooks. Please verify")
+    # Sets the user populated data. Admins whose org and token are unchanged are kept with their caches.
+    def load(self, data) -> None:
+        self.cluster.load(data)
+        self.orgs = data["orgs"]  # list of organizations
+        # allowed users and their emails for each organization
+        self.auth = AuthIndex(data["org_allowed_users"], data["org_id_to_email"])
+        self.room_to_org = data["room_to_org"]  # maps each room to its current org
+        self.admin_data = data["admin_data"]  # org and token of every initialized room
+
+        #  one admin for each org and token, shared by its rooms. Tokens are verified in startup()
+        #  Rooms owned by another node get theirs when one of their events is handled here, see admin_of()
+        admins = {}
+        room_to_admin = {}
+        for room, admin_data in data["admin_data"].items():
+            if not self.cluster.owns(room, self.room_to_org.get(room)):
+                continue
+            key = (admin_data["org_id"], admin_data["admin_token"])
+            admin = admins.get(key) or self.admins.get(key)
+            if admin is None:
+                admin = helper.create_admin(admin_data["admin_token"], admin_data["org_id"], room,
+                                            admin_data.get("token_set_at"))
+            admins[key] = admin
+            room_to_admin[room] = admin
+        self.admins = admins
+        self.room_to_admin = room_to_admin
+
+    # Loads the state again if another process (e.g. another gunicorn worker) changed it in the store
+    def sync(self) -> None:
+        data_version = self.store.data_version()
+        if data_version != self.data_version:
+            with self.state.exclusive():
+                if data_version == self.data_version:
+                    return  # reloaded by another thread meanwhile
+                print("State changed by another process. Reloading.")
+                self.load(self.store.load())
+                self.data_version = data_version
+
+    # Loads the state again after the cluster's nodes changed, keeping the admins of the rooms this node
+    # owns now and letting go of the others. Provisioning already running for a room that moved finishes
+    # here with the admin it started with.
+    def rebalance(self) -> None:
+        with self.state.exclusive():
+            self.load(self.store.load())
+        print(f"Owning {len(self.room_to_admin)} of {len(self.admin_data)} rooms.")
 
+    def startup(self) -> None:
+        # with several processes sharing the store, only the first one to start sets up the webhooks
+        if webhooks.URL and self.store.claim("reconcile_webhooks", STARTUP_TIMEOUT):
+            desired = webhooks.desired_webhooks(webhooks.URL, self.id)
+            try:
+                self.webhooks = aio.run(webhooks.reconcile(self.bot_token, desired), timeout=STARTUP_TIMEOUT) or []
+            except FutureTimeoutError:
+                # e.g. Webex asked to retry much later. Reconciling goes on in the background, the bot starts.
+                print(f"Webhooks not set up within {STARTUP_TIMEOUT:.0f}s, still trying in the background.")
+            except Exception as e:
+                print(f"Could not set up webhooks: {e!r}")
+            if len(self.webhooks) < len(desired):
+                print("Don't have all webhooks. Please verify")
+        elif not webhooks.URL:
+            self.webhooks = list(self.api.webhooks.list())
+            print("BOT_URL not set, webhooks are not set up. Please verify")
+        # with several processes sharing the store, only the first one to start verifies the tokens (of the
+        # rooms it owns, if sharded)
+        if self.store.claim(f"verify_admins:{self.cluster.self_url}", STARTUP_TIMEOUT):
+            self.verify_admins()
+
+    # Verifies the tokens of all admins concurrently, one check per org and token. Rooms whose token was
+    # rejected (401 or 403) are asked to reinitialize. Tokens that could not be checked, because of another
+    # error (e.g. 429 or 5xx during a Webex outage) or the timeout, are left to be checked on first use.
+    def verify_admins(self) -> None:
+        if not self.admins:
+            return
+        print(f"Verifying {len(self.admins)} tokens for {len(self.room_to_admin)} rooms.")
+        executor = ThreadPoolExecutor(max_workers=STARTUP_WORKERS)
+        futures = {executor.submit(admin.verify): admin for admin in self.admins.values()}
+        done, not_done = wait(futures, timeout=STARTUP_TIMEOUT)
+        executor.shutdown(wait=False, cancel_futures=True)
+        if not_done:
+            print(f"{len(not_done)} tokens not verified in time. They will be checked on first use.")
+        for future in done:
+            admin = futures[future]
+            if future.exception() is not None:
+                print(f"Could not verify token: {future.exception()!r}. It will be checked on first use.")
+            elif not future.result():
+                # if admin fails to get id, its rooms should be reinitialized
+                self.drop_admin(admin)
+
+    # State is saved on every change, only the store needs closing
     def teardown(self) -> None:
-        admins_saved = {}
-        for room in self.room_to_admin.keys():
-            admins_saved[room] = self.room_to_admin[room].save()
-        data = {
-            "bot_name": self.name,
-            "bot_token": self.bot_token,
-            "bot_email": self.email,
-            "orgs": self.orgs,
-            "admin_data": admins_saved,
-            "org_allowed_users": self.org_allowed_users,
-            "room_to_org": self.room_to_org,
-            "org_id_to_email": self.org_id_to_email
-        }
-        with open("bot_data.json", "w") as file:
-            json.dump(data, file)
+        self.store.close()
 
     def init_org(self, org_id, access_token, room_id, user_id):
         # check if this room is known already
-        try:
-            admin = self.room_to_admin[room_id]
+        if room_id in self.admin_data:
             print("Bot knows this room.")
-            if org_id != admin.org_id:
-                print("Room wants to change organization.")
-                self.room_to_org[room_id] = org_id
-            admin.update_token(access_token)
-            print("Token updated.")
-            if not admin.token_is_valid():
-                self.reinit(room_id)
-                return None
-        except KeyError:
+        else:
             print("Bot does not know this room. Creating")
-            admin = helper.create_admin(access_token, org_id, room_id)
-            if not admin.token_is_valid():
-                del admin
-                return None
-            self.room_to_admin[room_id] = admin
-            self.org_id_to_email[org_id] = {}
+        admin = self.get_admin(org_id, access_token, room_id)
+        if not admin.token_is_valid(force=True):
+            if room_id in self.admin_data:
+                self.reinit(room_id)
+            return None
+        email = self.get_email_from_id(user_id, room_id)
+
+        # the API calls are done, the locks are only held while the state changes
+        with self.state.shared(), self.room_locks.get(room_id), self.org_locks.get(org_id):
+            # another room of the org may have stored an admin for this token meanwhile
+            admin = self.admins.get((org_id, access_token), admin)
+            old_data = self.admin_data.get(room_id)
+            org_token_changed = (old_data is not None and old_data["org_id"] == org_id
+                                 and old_data["admin_token"] != access_token)
+            if org_token_changed:
+                self.store.save_org_token(org_id, access_token, admin.token_set_at)
+            elif old_data is not None and old_data["org_id"] != org_id:
+                print("Room wants to change organization.")
+            room_data = {"admin_token": access_token, "org_id": org_id, "token_set_at": admin.token_set_at}
+            with self.maps_lock:
+                admin_data = dict(self.admin_data)
+                if org_token_changed:
+                    # also the org's rooms owned by other nodes, they pick the token up from the store
+                    org_rooms = [room for room, other in admin_data.items() if other["org_id"] == org_id]
+                    admin_data.update(dict.fromkeys(org_rooms, room_data))
+                admin_data[room_id] = room_data
+                self.admin_data = admin_data
+                room_to_admin = dict(self.room_to_admin)
+                if org_token_changed:
+                    # a new token for the org, all of its rooms use it from now on
+                    rooms = [room for room, other in room_to_admin.items() if other.org_id == org_id]
+                    room_to_admin.update(dict.fromkeys(rooms, admin))
+                    print(f"Token updated for {len(rooms)} rooms.")
+                room_to_admin[room_id] = admin
+                # admins no room uses anymore, e.g. after their org got a new token, are forgotten
+                used = {id(other) for other in room_to_admin.values()}
+                admins = {key: other for key, other in self.admins.items() if id(other) in used}
+                admins[(org_id, access_token)] = admin
+                self.admins, self.room_to_admin = admins, room_to_admin
+            self.store.save_admin(room_id, access_token, org_id, admin.token_set_at)
+
+            if org_id not in self.orgs:
+                with self.maps_lock:
+                    self.orgs = self.orgs + [org_id]
+                self.store.save_org(org_id)
+            self.allow_user(org_id, user_id, email)
+            self.replace_map("room_to_org", lambda room_to_org: room_to_org.update({room_id: org_id}))
+            self.store.save_room(room_id, org_id)
+
+        return admin
 
-        self.add_allowed_user(org_id, room_id, user_id=user_id)
-        self.room_to_org[room_id] = org_id
+    # Admin of a room. A room owned by another node gets one the first time one of its events is handled
+    # here, e.g. because it was queued before the room moved or its owner could not be reached.
+    # Raises KeyError if the room isn't initialized.
+    def admin_of(self, room_id):
+        admin = self.room_to_admin.get(room_id)
+        if admin is not None:
+            return admin
+        with self.maps_lock:
+            # looked up again, the room may have been initialized meanwhile
+            admin = self.room_to_admin.get(room_id)
+            if admin is not None:
+                return admin
+            admin_data = self.admin_data[room_id]
+            key = (admin_data["org_id"], admin_data["admin_token"])
+            admin = self.admins.get(key)
+            if admin is None:
+                admin = helper.create_admin(key[1], key[0], room_id, admin_data.get("token_set_at"))
+            self.admins = {**self.admins, key: admin}
+            self.room_to_admin = {**self.room_to_admin, room_id: admin}
+        return admin
 
+    # Replaces one of the maps of the user populated data with a copy changed by change(copy)
+    def replace_map(self, name, change) -> None:
+        with self.maps_lock:
+            mapping = dict(getattr(self, name))
+            change(mapping)
+            setattr(self, name, mapping)
+
+    # Returns the admin shared by the rooms of an org using this token, or a new one if there is none yet
+    def get_admin(self, org_id, access_token, room_id):
+        admin = self.admins.get((org_id, access_token))
+        if admin is None:
+            admin = helper.create_admin(access_token, org_id, room_id, time.time())
         return admin
 
+    # Rooms using an admin
+    def rooms_of(self, admin) -> list:
+        return [room for room, other in self.room_to_admin.items() if other is admin]
+
+    # Forgets an admin whose token was rejected and asks its rooms to reinitialize. Until they do, their
+    # requests go to initialization without trying the token again.
+    def drop_admin(self, admin) -> None:
+        with self.state.shared():
+            for room in self.rooms_of(admin):
+                with self.room_locks.get(room), self.org_locks.get(admin.org_id):
+                    if self.room_to_admin.get(room) is not admin:
+                        continue  # reinitialized meanwhile
+                    self.replace_map("room_to_admin", lambda room_to_admin: room_to_admin.pop(room, None))
+                    self.replace_map("admin_data", lambda admin_data: admin_data.pop(room, None))
+                    self.store.delete_admin(room)
+                self.reinit(room)
+            with self.org_locks.get(admin.org_id):
+                if not self.rooms_of(admin):
+                    self.replace_map("admins", lambda admins: admins.pop((admin.org_id, admin.my_token), None))
+
     def reinit(self, room_id):
-        self.api.messages.create(roomId=room_id, text="Access token not valid or expired. Please reinitialize.")
-        self.api.messages.create(room_id, text="Please initialize", attachments=[self.init_card])
+        self.outbox.send(room_id, text="Access token not valid or expired. Please reinitialize.")
+        self.send_card(room_id, self.init_card)
+
+    # Sends a compiled card to a room, see cards.CardMessage
+    def send_card(self, room_id, card_message, **fields) -> None:
+        self.outbox.send(room_id, card=card_message, **fields)
 
     def get_email_from_id(self, person_id, room_id) -> str:
-        try:
-            memberships = self.api.memberships.list(roomId=room_id, personId=person_id)
-            email = ""
-            for membership in memberships:
-                email = membership.personEmail
-            return email
-        except ApiError:
-            return ""
+        return self.people.get_email(person_id, room_id)
 
-        # Converts email to User ID. Needed for allowed users list. Returns empty string if email not found.
+    # Converts email to User ID. Needed for allowed users list. Returns empty string if email not found.
     def get_id_from_email(self, email, room_id) -> str:
-        try:
-            memberships = self.api.memberships.list(roomId=room_id, personEmail=email)
-            user_id = ""
-            for membership in memberships:
-                user_id = membership.personId
-            return user_id
-        except ApiError:
-            return ""
+        return self.people.get_id(email, room_id)
 
     def remove_room_from_org(self, room_id):
-        del self.room_to_org[room_id]
+        with self.state.shared(), self.room_locks.get(room_id):
+            self.replace_map("room_to_org", lambda room_to_org: room_to_org.pop(room_id, None))
+            self.store.delete_room(room_id)
 
     def add_allowed_user(self, org_id, room_id, email=None, user_id=None):
         if not user_id:
@@ -132,163 +321,315 @@ class Bot:
             return ""
         if user_id == "":
             return user_id
-        if org_id in self.orgs:
-            if user_id not in self.org_allowed_users[org_id]:
-                self.org_allowed_users[org_id].append(user_id)
-                self.org_id_to_email[org_id][user_id] = email
-                print(f"Added user {email} to allowed for org {org_id}.")
-        else:
-            self.org_allowed_users[org_id] = [user_id]
-            self.org_id_to_email[org_id][user_id] = email
+        self.allow_user(org_id, user_id, email)
         return user_id
 
-    def remove_allowed_user(self, org_id, email, room_id):
-        user_id = self.get_id_from_email(email, room_id)
-        if user_id != "" and user_id in self.org_allowed_users[org_id]:
-            self.org_allowed_users[org_id].remove(user_id)
-            print(f"Removed user {email} from allowed for org {org_id}.")
-            return user_id
-        else:
-            return ""
+    # Allows a user whose ID and email are known
+    def allow_user(self, org_id, user_id, email) -> None:
+        with self.state.shared(), self.org_locks.get(org_id):
+            if self.auth.add(org_id, user_id, email):
+                self.store.save_allowed_user(org_id, user_id, email)
+                print(f"Added user {email} to allowed for org {org_id}.")
+
+    # Adds several users by email. Returns the emails that were added and the ones that were not found.
+    def add_allowed_users(self, org_id, room_id, emails) -> tuple:
+        user_ids = self.people.get_ids(emails, room_id)
+        found = [(user_ids[email], email) for email in emails if user_ids[email] != ""]
+        with self.state.shared(), self.org_locks.get(org_id):
+            for user_id in self.auth.add_many(org_id, found):
+                self.store.save_allowed_user(org_id, user_id, self.auth.get_email(org_id, user_id))
+        print(f"Added {len(found)} users to allowed for org {org_id}.")
+        return [email for user_id, email in found], [email for email in emails if user_ids[email] == ""]
+
+    # Removes several users by email. Returns the emails that were removed and the ones that were not allowed.
+    def remove_allowed_users(self, org_id, room_id, emails) -> tuple:
+        # allowed users are known by email already, only ask the API for unknown addresses
+        user_ids = {email: self.auth.get_id(org_id, email) for email in emails}
+        unknown = [email for email, user_id in user_ids.items() if user_id == ""]
+        if unknown:
+            user_ids.update(self.people.get_ids(unknown, room_id))
+        with self.state.shared(), self.org_locks.get(org_id):
+            known = [user_ids[email] for email in emails if user_ids[email] != ""]
+            removed_ids = self.auth.remove_many(org_id, known)
+            for user_id in removed_ids:
+                self.store.delete_allowed_user(org_id, user_id)
+        removed_ids = set(removed_ids)
+        removed = [email for email in emails if user_ids[email] in removed_ids]
+        print(f"Removed {len(removed)} users from allowed for org {org_id}.")
+        removed_set = set(removed)
+        return removed, [email for email in emails if email not in removed_set]
 
     def handle_added(self, room_id):
-        self.api.messages.create(room_id, text="Hello! I'm here to help you provision Webex Boards for your "
-                                               "organization. Please provide me with your organization ID and an "
-                                               "admin's access token.")
-        self.api.messages.create(room_id, text="Please initialize", attachments=[self.init_card])
+        self.sync()
+        self.outbox.send(room_id, text="Hello! I'm here to help you provision Webex Boards for your organization. "
+                                       "Please provide me with your organization ID and an admin's access token.")
+        self.send_card(room_id, self.init_card)
 
     # currently not in use, if want to use please rework
     def handle_removed(self, room_id):
+        self.sync()
         org_id = self.room_to_org[room_id]
         self.remove_room_from_org(room_id)
         # if org_id not in self.room_to_org.values():
             # del self.room_to_admin[room_id]
 
     def handle_unauthorized(self, org_id, actor_id, room_id):
-        print(f"User {self.org_id_to_email[org_id][actor_id]} unauthorized.")
-        self.api.messages.create(room_id, text=self.unauthorized_message)
+        print(f"User {self.auth.get_email(org_id, actor_id)} unauthorized.")
+        self.outbox.send(room_id, text=self.unauthorized_message)
+
+    # Is called when bot is mentioned. Loads the message and handles it as a command
+    def handle_mention(self, message_id, room_id, actor_id) -> None:
+        self.sync()
+        message = self.api.messages.get(message_id)
+        self.handle_command(message.text, room_id, actor_id)
 
     # Is called when card was submitted. Asks Admin to create activation code and sends it in the chat
     def handle_card(self, attachment_id, room_id, actor_id):
+        self.sync()
         card_input = self.api.attachment_actions.get(id=attachment_id)
         try:
             org_id = self.room_to_org[room_id]
-            admin = self.room_to_admin[room_id]
+            admin = self.admin_of(room_id)
         except KeyError:
             try:
                 org_id = card_input.inputs["org_id"]
-                access_token = card_input.inputs["access_token"]
-                admin = self.init_org(org_id, access_token, room_id, actor_id)
-                if admin:
-                    self.api.messages.create(room_id, text="Initialization success.")
-                else:
-                    self.api.messages.create(room_id, text="Initialization unsuccessful. Please check your "
-                                                           "organization ID and access token or contact "
-                                                           "agrobys@cisco.com for assistance.")
+                admin = self.initialize(card_input.inputs, room_id, actor_id)
+                if not admin:
                     return
             except KeyError:
-                self.api.messages.create(room_id, text="Please initialize", attachments=[self.init_card])
+                self.send_card(room_id, self.init_card)
                 return
-        if actor_id in self.org_allowed_users[org_id]:
+        if self.auth.is_allowed(org_id, actor_id):
             try:
-                print(f"User {self.org_id_to_email[org_id][actor_id]} allowed.")
+                print(f"User {self.auth.get_email(org_id, actor_id)} allowed.")
                 workspace_name = card_input.inputs["workspace"].strip()
+                existing = card_input.inputs.get("existing", "")
+                create_new = card_input.inputs.get("create_new") == "true"
             except KeyError:
-                self.api.messages.create(room_id, text="Bot initialized. If you need to update the access token, "
-                                                       "please use the 'reinit' command, or type "
-                                                       "'help' to view all available commands.")
+                if "org_id" in card_input.inputs and "access_token" in card_input.inputs:
+                    # the init card filled out in a room that is still initialized, e.g. after the warning
+                    # that its token expires soon
+                    self.initialize(card_input.inputs, room_id, actor_id)
+                    return
+                self.outbox.send(room_id, text="Bot initialized. If you need to update the access token, please use "
+                                               "the 'reinit' command, or type 'help' to view all available commands.")
                 return
             # model = card_input.inputs["model"]
             # if model != "":
             #     activation_code = get_activation_code(workspace_name, model=model)
-            activation_code = admin.get_activation_code(workspace_name)
-            if activation_code == "":
-                self.api.messages.create(room_id,
-                                         text="Something went wrong. Please check if you need to update the access "
-                                              "token or if you've been sending too many requests.")
-                return
-            activation_code = helper.split_code(activation_code)
-            print(f"Sending activation code.")
-            self.api.messages.create(room_id, text=f"Here's your activation code: {activation_code} for workspace {workspace_name}")
+            # a workspace picked in the card and the name typed in, as it was typed; several workspaces at
+            # once are asked for with the provision command
+            workspace_names = [name for name in dict.fromkeys((existing, workspace_name)) if name] or [workspace_name]
+            # runs on the async client, the worker is free for the next event meanwhile
+            aio.submit(self.provision(admin, room_id, workspace_names, create_new))
         else:
             self.handle_unauthorized(org_id, actor_id, room_id)
 
+    # Initializes a room with the org and token entered in the init card and tells the room how it went.
+    # Returns the admin, None if the token was not accepted. Raises KeyError if the card lacks them.
+    def initialize(self, inputs, room_id, actor_id):
+        admin = self.init_org(inputs["org_id"], inputs["access_token"], room_id, actor_id)
+        if admin:
+            self.outbox.send(room_id, text="Initialization success.")
+        else:
+            self.outbox.send(room_id, text="Initialization unsuccessful. Please check your organization ID "
+                                           "and access token or contact agrobys@cisco.com for assistance.")
+        return admin
+
+    # Gets activation codes for one or several workspaces and sends them in one message. Runs on the async
+    # client; provisioning for the same room happens in order. Names close to an existing workspace are only
+    # created if create_new is set, else the user is asked first.
+    async def provision(self, admin, room_id, workspace_names, create_new=False) -> None:
+        if len(workspace_names) > BULK_LIMIT:
+            self.outbox.send(room_id, text=f"Please provision at most {BULK_LIMIT} workspaces at once.")
+            return
+        room_lock = self.provision_locks.setdefault(room_id, asyncio.Lock())
+        with metrics.timer(metrics.provisioning_seconds, "one" if len(workspace_names) == 1 else "many"):
+            async with room_lock:
+                if not create_new:
+                    workspace_names = await self.check_names(admin, room_id, workspace_names)
+                    if not workspace_names:
+                        return
+                if len(workspace_names) == 1:
+                    await self.provision_one(admin, room_id, workspace_names[0])
+                else:
+                    await self.provision_many(admin, room_id, workspace_names)
+
+    # Matches names against the org's workspace index. Names of existing workspaces are returned as they are
+    # spelled there. Names that don't exist but are close to existing ones (likely typos) are left out and the
+    # user is asked about them, with a card for each name.
+    async def check_names(self, admin, room_id, workspace_names) -> list:
+        index = workspaces.get_index(admin.org_id)
+        index.refresh_soon(admin.my_token)
+        # comparing many names with a large index takes a while, the event loop goes on meanwhile
+        checked, suggestions = await asyncio.get_running_loop().run_in_executor(None, match_names, index,
+                                                                                workspace_names)
+        if suggestions:
+            lines = "".join(f"\n- {workspace_name}: did you mean {' or '.join(similar)}?"
+                            for workspace_name, similar in suggestions.items())
+            with_cards = len(suggestions) <= SUGGESTION_CARDS
+            if with_cards:
+                advice = "Pick the workspace in each card, or turn on 'Create a new workspace' to create it anyway."
+            else:
+                advice = "Please use the provision command again with the names you meant."
+            self.outbox.send(room_id, markdown=f"No workspace found for these names, but similar ones exist:{lines}"
+                                               f"\n\n{advice}")
+            if with_cards:
+                card_message = self.get_code_card(admin)
+                for workspace_name in suggestions:
+                    self.send_card(room_id, card_message, workspace=workspace_name)
+        return checked
+
+    # The code card for an admin's org, offering the org's workspaces once they are known
+    def get_code_card(self, admin) -> cards.CardMessage:
+        index = workspaces.get_index(admin.org_id)
+        index.refresh_soon(admin.my_token)
+        if index.synced_at is None or not 0 < len(index) <= WORKSPACE_PICKER_LIMIT:
+            return self.code_card
+        return cards.get_variant(("code_card", admin.org_id, index.version),
+                                 lambda: cards.CardMessage(helper.make_code_card(index.names()),
+                                                           text="Here's your card", workspace=""))
+
+    async def provision_one(self, admin, room_id, workspace_name) -> None:
+        activation_code = await admin.aio.get_activation_code(workspace_name)
+        if activation_code == "":
+            self.outbox.send(room_id, text="Something went wrong. Please check if you need to update the access token "
+                                           "or if you've been sending too many requests.")
+            return
+        activation_code = helper.split_code(activation_code)
+        print(f"Sending activation code.")
+        self.outbox.send(room_id, text=f"Here's your activation code: {activation_code} for workspace {workspace_name}")
+        self.tracker.track(admin, room_id, [workspace_name])
+
+    async def provision_many(self, admin, room_id, workspace_names) -> None:
+        print(f"Provisioning {len(workspace_names)} workspaces.")
+        codes = await admin.aio.get_activation_codes(workspace_names)
+        failed = [workspace_name for workspace_name, code in codes.items() if code == ""]
+        issued = {workspace_name: helper.split_code(code) for workspace_name, code in codes.items() if code != ""}
+        self.tracker.track(admin, room_id, list(issued))
+        text = f"Here are your activation codes for {len(issued)} of {len(codes)} workspaces."
+        if failed:
+            text += (f"\n\nNo code for: {', '.join(failed)}. Please check if you need to update the access token or "
+                     f"if you've been sending too many requests.")
+        if len(issued) > CSV_THRESHOLD:
+            # file uploads go through the SDK, off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, self.send_csv, room_id, text, issued)
+        else:
+            lines = "".join(f"\n- {workspace_name}: {code}" for workspace_name, code in issued.items())
+            self.outbox.send(room_id, markdown=text + lines)
+
+    def send_csv(self, room_id, text, codes) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "activation_codes.csv")
+            with open(path, "w", newline="") as file:
+                writer = csv.writer(file)
+                writer.writerow(["workspace", "activation_code"])
+                writer.writerows(codes.items())
+            self.api.messages.create(room_id, markdown=text, files=[path])
+
     # Is called when bot is mentioned. Checks for commands (if no special command is detected, it will send the
-    # adaptive card)
+    # adaptive card). Commands are registered with router.command below.
     def handle_command(self, message, room_id, actor_id) -> None:
+        words = message.split()
         # Ignore @All mentions
-        if message.split()[0] == "All":
+        if words and words[0] == "All":
             return
         # Make sure bot is initialized for this room
         try:
             org_id = self.room_to_org[room_id]
-            admin = self.room_to_admin[room_id]
+            admin = self.admin_of(room_id)
         except KeyError:
-            self.api.messages.create(room_id, text="Please initialize", attachments=[self.init_card])
+            self.send_card(room_id, self.init_card)
             return
 
         # Strips bot mention from command
-        if message.split()[0] == self.name:
-            command = message.split()[1:]
-        else:
-            command = message.split()
-        print(f"Command: {' '.join(command)}")
-
-        # Command empty, send card
-        if len(command) == 0:
-            print("Sending card")
-            self.api.messages.create(room_id, text="Here's your card", attachments=[self.code_card])
-
-        elif command[0] == "reinit":
-            if actor_id in self.org_allowed_users[org_id]:
-                self.remove_room_from_org(room_id)
-                self.api.messages.create(room_id, text="Please initialize", attachments=[self.init_card])
-            else:
-                self.handle_unauthorized(org_id, actor_id, room_id)
+        if words and words[0] == self.name:
+            words = words[1:]
+        print(f"Command: {' '.join(words)}")
 
-        elif command[0] == "help":
-            self.api.messages.create(room_id, text=f"To initialize the bot, please fill out the card. If you don't "
-                                                   f"see the card, mention the bot to receive it. If the bot is "
-                                                   f"already initialized, mention the bot to receive a card to fill "
-                                                   f"out to get an activation code.\n\nOther commands include:\n- "
-                                                   f"add [email]: add an authorized user to your organization; add "
-                                                   f"several at once separated with a space\n- "
-                                                   f"remove [email]: remove an authorized user from your organization; "
-                                                   f"remove several at once separated with a space\n- "
-                                                   f"reinit: change organization and/or token for this room\n "
-                                                   f"If you require further assistance, please contact me "
-                                                   f"at agrobys@cisco.com.")
-
-        # Adds allowed users on "add" command
-        elif len(command) > 1 and command[0] == "add":
-            if actor_id in self.org_allowed_users[org_id]:
-                print(f"User {self.org_id_to_email[org_id][actor_id]} allowed.")
-                for email in command[1:]:
-                    user_id = self.add_allowed_user(org_id, room_id, email=email)
-                    # Empty user_id means provided email was not found
-                    if user_id == "":
-                        self.api.messages.create(room_id, text=f"Something went wrong. If {email} was valid, check if you need to update your access token.")
-                    else:
-                        self.api.messages.create(room_id, text=f"User {email} added successfully.")
-            else:
-                self.handle_unauthorized(org_id, actor_id, room_id)
-
-        # Removes allowed users on "remove" command
-        elif len(command) > 1 and command[0] == "remove":
-            if actor_id in self.org_allowed_users[org_id]:
-                print(f"User {self.org_id_to_email[org_id][actor_id]} allowed.")
-                for email in command[1:]:
-                    user_id = self.remove_allowed_user(org_id, email, room_id)
-                    # Empty user_id means provided email was not found
-                    if user_id == "":
-                        self.api.messages.create(room_id,
-                                                 text=f"User not found in allowed list. If {email} was valid, check if you need to update your access token.")
-                    else:
-                        self.api.messages.create(room_id, text=f"User {email} removed successfully.")
+        command = router.match(words)
+        # Sends card if no special command is detected
+        if command is None:
+            if words:
+                print(f"Sending card (No known command detected).")
             else:
+                print("Sending card")
+            self.send_card(room_id, self.get_code_card(admin))
+            return
+        if command.allowed_only:
+            if not self.auth.is_allowed(org_id, actor_id):
                 self.handle_unauthorized(org_id, actor_id, room_id)
-
-        # Sends card if no special command is detected
+                return
+            print(f"User {self.auth.get_email(org_id, actor_id)} allowed.")
+        command.handler(self, Invocation(room_id, actor_id, org_id, admin, words[1:]))
+
+    # Adds allowed users on "add" command
+    @router.command("add", min_args=1, usage="add [email]: add an authorized user to your organization; add "
+                                              "several at once separated with a space")
+    def command_add(self, invocation) -> None:
+        added, failed = self.add_allowed_users(invocation.org_id, invocation.room_id,
+                                               list(dict.fromkeys(invocation.args)))
+        text = []
+        if added:
+            text.append(f"Users added successfully: {', '.join(added)}.")
+        # Emails not found in this room
+        if failed:
+            text.append(f"Something went wrong for: {', '.join(failed)}. If these were valid, check if "
+                        f"you need to update your access token.")
+        self.outbox.send(invocation.room_id, text="\n".join(text))
+
+    # Removes allowed users on "remove" command
+    @router.command("remove", aliases=("delete",), min_args=1,
+                    usage="remove [email]: remove an authorized user from your organization; remove several at "
+                          "once separated with a space")
+    def command_remove(self, invocation) -> None:
+        removed, failed = self.remove_allowed_users(invocation.org_id, invocation.room_id,
+                                                    list(dict.fromkeys(invocation.args)))
+        text = []
+        if removed:
+            text.append(f"Users removed successfully: {', '.join(removed)}.")
+        # Emails not found in the allowed list
+        if failed:
+            text.append(f"Users not found in allowed list: {', '.join(failed)}. If these were valid, check "
+                        f"if you need to update your access token.")
+        self.outbox.send(invocation.room_id, text="\n".join(text))
+
+    # Gets activation codes for several workspaces on "provision" command
+    @router.command("provision", min_args=1,
+                    usage="provision [names]: get activation codes for several workspaces, separated with a "
+                          "comma; ranges like Room-{1..40} are expanded")
+    def command_provision(self, invocation) -> None:
+        workspace_names = helper.expand_workspace_names(" ".join(invocation.args))
+        aio.submit(self.provision(invocation.admin, invocation.room_id, workspace_names))
+
+    @router.command("reinit", usage="reinit: change organization and/or token for this room")
+    def command_reinit(self, invocation) -> None:
+        self.remove_room_from_org(invocation.room_id)
+        self.send_card(invocation.room_id, self.init_card)
+
+    @router.command("help", aliases=("?",), allowed_only=False)
+    def command_help(self, invocation) -> None:
+        commands = "".join(f"\n- {usage}" for usage in router.usage())
+        self.outbox.send(invocation.room_id,
+                         text=f"To initialize the bot, please fill out the card. If you don't see the card, mention "
+                              f"the bot to receive it. If the bot is already initialized, mention the bot to receive "
+                              f"a card to fill out to get an activation code.\n\nOther commands include:{commands}\n "
+                              f"If you require further assistance, please contact me at agrobys@cisco.com.")
+
+
+# Splits names into those to provision (existing ones as they are spelled in the index) and likely typos,
+# name -> similar existing names
+def match_names(index, workspace_names) -> tuple:
+    checked = []
+    suggestions = {}
+    for workspace_name in workspace_names:
+        existing = index.find(workspace_name)
+        if existing:
+            checked.append(existing)
+            continue
+        similar = index.suggest(workspace_name)
+        if similar:
+            suggestions[workspace_name] = similar
         else:
-            print(f"Sending card (No known command detected).")
-            self.api.messages.create(room_id, text="Here's your card", attachments=[self.code_card])
+            checked.append(workspace_name)
+    return list(dict.fromkeys(checked)), suggestions
@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Marker for "no value", also used to cache negative lookups
+MISSING = object()
+ABSENT = object()  # returned by get() internally when there is no entry at all
+
+
+# Thread-safe LRU cache whose entries expire after a time to live (in seconds).
+# Once maxsize is reached, the least recently used entry is dropped.
+class TTLCache:
+
+    def __init__(self, maxsize=1024, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires_at, value = self.entries[key]
+            except KeyError:
+                return default
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    # ttl overrides the cache's default time to live for this entry
+    def set(self, key, value, ttl=None) -> None:
+        with self.lock:
+            self.put(key, value, ttl)
+
+    # Sets the entry only if there is none yet. Returns False if the key was already present.
+    def add(self, key, value=True, ttl=None) -> bool:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return False
+            self.put(key, value, ttl)
+            return True
+
+    # Stores an entry and drops the least recently used ones over maxsize. Caller holds the lock.
+    def put(self, key, value, ttl) -> None:
+        self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def delete(self, key) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, ABSENT) is not ABSENT
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.entries)
@@ -0,0 +1,47 @@
+import json
+import re
+import uuid
+from webexteamssdk.utils import make_attachment
+from cache import TTLCache
+
+# marks a field in a card, unique to this process so no workspace name or other content can contain it
+FIELD_MARKER = uuid.uuid4().hex
+FIELDS = re.compile(rb'"' + FIELD_MARKER.encode() + rb':(\w+)"')  # a field's value in a serialized card
+
+
+# Value standing for a field of a card, filled in on every send (see CardMessage)
+def field(name) -> str:
+    return f"{FIELD_MARKER}:{name}"
+
+
+# A message carrying an adaptive card, serialized to the JSON body of a messages request once. Sending it
+# only fills in the fields (the room ID, the text and any field(name) used as a value in the card) instead
+# of serializing the card model again.
+class CardMessage:
+
+    def __init__(self, card, text, **defaults):
+        payload = {"roomId": field("room_id"), "text": field("text"), "attachments": [make_attachment(card)]}
+        self.defaults = dict(defaults, text=text)
+        # literal parts and field names alternate
+        self.parts = FIELDS.split(json.dumps(payload, separators=(",", ":")).encode())
+
+    # Returns the request body with the fields filled in. Fields not given take their default.
+    def render(self, **fields) -> bytes:
+        parts = list(self.parts)
+        for index in range(1, len(parts), 2):
+            name = parts[index].decode()
+            value = fields[name] if name in fields else self.defaults[name]
+            parts[index] = json.dumps(str(value)).encode()
+        return b"".join(parts)
+
+
+variants = TTLCache(maxsize=1000, ttl=3600)  # compiled variants of cards, e.g. per org or language
+
+
+# Returns the compiled card for a key, compiling it with build() the first time
+def get_variant(key, build) -> CardMessage:
+    card_message = variants.get(key)
+    if card_message is None:
+        card_message = build()
+        variants.set(key, card_message)
+    return card_message
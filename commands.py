@@ -0,0 +1,52 @@
+from __future__ import print_function  # Needed if you want to have console output using Flask
+from collections import namedtuple
+
+# What a command handler gets: where and by whom it was called, the room's org and admin and the words
+# after the command
+Invocation = namedtuple("Invocation", ["room_id", "actor_id", "org_id", "admin", "args"])
+
+
+# A command the bot understands when mentioned
+class Command:
+
+    def __init__(self, name, handler, aliases=(), allowed_only=True, min_args=0, usage=None):
+        self.name = name
+        self.handler = handler
+        self.aliases = aliases
+        self.allowed_only = allowed_only  # only users allowed for the room's org may use it
+        self.min_args = min_args  # with fewer arguments, the message is not taken as this command
+        self.usage = usage  # line describing the command in the help, None to leave it out
+
+
+# Maps command words (names and aliases) to commands. Commands are registered with the command decorator on
+# Bot methods, so a mention costs one split of the message and one dict lookup however many commands exist.
+class Router:
+
+    def __init__(self):
+        self.commands = {}  # lowercase name or alias -> command
+        self.ordered = []  # in the order they were registered, for the help
+
+    def command(self, name, aliases=(), allowed_only=True, min_args=0, usage=None):
+        def register(handler):
+            command = Command(name, handler, aliases, allowed_only, min_args, usage)
+            for word in (name,) + tuple(aliases):
+                self.commands[word.lower()] = command
+            self.ordered.append(command)
+            return handler
+        return register
+
+    # Returns the command for the words of a message (without the bot's name), None if there is none
+    def match(self, words):
+        if not words:
+            return None
+        command = self.commands.get(words[0].lower())
+        if command is None or len(words) - 1 < command.min_args:
+            return None
+        return command
+
+    # Help lines of the registered commands
+    def usage(self) -> list:
+        return [command.usage for command in self.ordered if command.usage]
+
+
+router = Router()
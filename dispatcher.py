@@ -0,0 +1,107 @@
+from __future__ import print_function  # Needed if you want to have console output using Flask
+from collections import deque
+import queue
+import threading
+import time
+import zlib
+import metrics
+
+
+# Runs webhook handlers off the request path. Each room is pinned to one worker (by hashing the room ID), so
+# events of a room are handled in the order they arrived while different rooms are handled in parallel.
+class Dispatcher:
+
+    def __init__(self, workers=4, max_queue=1000, samples=1000):
+        self.queues = [queue.Queue(maxsize=max_queue) for _ in range(workers)]
+        self.threads = []
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        # recent time spent waiting in the queue and running the handler, in seconds
+        self.wait_times = deque(maxlen=samples)
+        self.run_times = deque(maxlen=samples)
+
+    def start(self) -> None:
+        for number, work_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self.work, args=(work_queue,), name=f"dispatcher-{number}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # Waits until queued events are handled and stops the workers. Gives up after timeout seconds in total.
+    def stop(self, timeout=None) -> None:
+        for work_queue in self.queues:
+            work_queue.put(None)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        self.threads = []
+
+    # Queues a handler call for a room. Returns False if the room's queue is full.
+    def submit(self, room_id, handler, *args) -> bool:
+        work_queue = self.queues[zlib.crc32(room_id.encode()) % len(self.queues)]
+        try:
+            work_queue.put_nowait((time.monotonic(), handler, args))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            print(f"Dispatcher queue full. Rejected event for room {room_id}.")
+            return False
+        with self.lock:
+            self.submitted += 1
+        return True
+
+    def work(self, work_queue) -> None:
+        while True:
+            item = work_queue.get()
+            if item is None:
+                break
+            queued_at, handler, args = item
+            started_at = time.monotonic()
+            failed = False
+            try:
+                handler(*args)
+            except Exception as e:
+                failed = True
+                print(f"Handler {handler.__name__} failed: {e!r}")
+            finished_at = time.monotonic()
+            metrics.queue_wait_seconds.observe(started_at - queued_at)
+            metrics.handler_seconds.observe(finished_at - started_at, handler.__name__)
+            if failed:
+                metrics.handler_errors.inc(handler.__name__)
+            with self.lock:
+                self.processed += 1
+                if failed:
+                    self.failed += 1
+                self.wait_times.append(started_at - queued_at)
+                self.run_times.append(finished_at - started_at)
+
+    def depth(self) -> int:
+        return sum(work_queue.qsize() for work_queue in self.queues)
+
+    def stats(self) -> dict:
+        with self.lock:
+            wait_times = sorted(self.wait_times)
+            run_times = sorted(self.run_times)
+            stats = {
+                "workers": len(self.queues),
+                "depth": self.depth(),
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "processed": self.processed,
+                "failed": self.failed,
+            }
+        stats["wait_p50"] = percentile(wait_times, 50)
+        stats["wait_p99"] = percentile(wait_times, 99)
+        stats["run_p50"] = percentile(run_times, 50)
+        stats["run_p99"] = percentile(run_times, 99)
+        return stats
+
+
+# Nearest-rank percentile of an already sorted list
+def percentile(values, p) -> float:
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[index]
@@ -1,19 +1,31 @@
-from webexteamssdk.models.cards import AdaptiveCard, TextBlock, Text
+from webexteamssdk.models.cards import AdaptiveCard, TextBlock, Text, Choice, Choices, Toggle, ChoiceInputStyle
 from webexteamssdk.models.cards.actions import Submit
 from admin import Admin
+import cards
 from json import JSONDecodeError
 import json
+import re
 
 
-# Creates the adaptive card for getting activation code
-def make_code_card() -> AdaptiveCard:
+# Creates the adaptive card for getting activation code. Given the names of existing workspaces, it also
+# offers them to pick from.
+def make_code_card(workspace_names=None) -> AdaptiveCard:
     greeting = TextBlock("Get an activation code:")
-    workspace = Text('workspace', placeholder="Enter Workspace Name")
+    body = [greeting]
+    if workspace_names:
+        choices = [Choice(workspace_name, workspace_name) for workspace_name in workspace_names]
+        body.append(Choices(choices, 'existing', style=ChoiceInputStyle.COMPACT, value=""))
+    workspace = Text('workspace', placeholder="Enter Workspace Name",
+                     value=cards.field("workspace"))  # filled in when the card is sent
+    body.append(workspace)
+    # names close to an existing workspace are only created if this is on
+    create_new = Toggle("Create a new workspace even if a similar one exists", 'create_new', value="false")
+    body.append(create_new)
     # model = Text('model', placeholder="Enter Device Model (Optional)")
     submit = Submit(title="Provision")
 
     card = AdaptiveCard(
-        body=[greeting, workspace], actions=[submit]
+        body=body, actions=[submit]
     )
     return card
 
@@ -33,8 +45,8 @@ def make_init_card() -> AdaptiveCard:
 
 # creates an admin for an organization. Each space has one admin using the user specified token to
 # perform actions on an organization.
-def create_admin(admin_token, org_id, room_id):
-    admin = Admin(admin_token, org_id, room_id)
+def create_admin(admin_token, org_id, room_id, token_set_at=None):
+    admin = Admin(admin_token, org_id, room_id, token_set_at)
     print("Admin created")
     return admin
 
@@ -44,6 +56,30 @@ def split_code(code) -> str:
     return code[:4] + '-' + code[4:8] + '-' + code[8:12] + '-' + code[12:]
 
 
+# Expands a list of workspace names separated by commas. Ranges like Room-{1..40} or Room-{01..40}
+# (zero padded) expand to one name per number. Duplicates are dropped, order is kept. Expansion stops
+# once more than limit names were produced.
+def expand_workspace_names(text, limit=1000) -> list:
+    names = {}
+    for part in text.split(","):
+        part = part.strip()
+        pending = [part] if part != "" else []
+        while pending and len(names) <= limit:
+            name = pending.pop()
+            match = re.search(r"\{(\d+)\.\.(\d+)\}", name)
+            if match is None:
+                names[name] = None
+                continue
+            start, end = match.group(1), match.group(2)
+            width = len(start) if start.startswith("0") else 0
+            step = 1 if int(end) >= int(start) else -1
+            numbers = range(int(start), int(end) + step, step)
+            # pushed in reverse so names come out in ascending order
+            for number in numbers[:limit + 1][::-1]:
+                pending.append(name[:match.start()] + str(number).zfill(width) + name[match.end():])
+    return list(names)
+
+
 def load_text(text):
     try:
         text = json.loads(text.content)
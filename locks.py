@@ -0,0 +1,70 @@
+import threading
+import weakref
+from contextlib import contextmanager
+
+
+# One reentrant lock per key, e.g. per org or per room, created on first use. Holders of different keys
+# don't wait for each other. A key's lock is forgotten once no thread holds or waits for it, so keys that
+# are no longer used (e.g. rooms the bot left) don't pile up.
+class KeyedLocks:
+
+    def __init__(self):
+        self.locks = weakref.WeakValueDictionary()  # key -> lock
+        self.lock = threading.Lock()
+
+    def get(self, key) -> threading.RLock:
+        with self.lock:
+            lock = self.locks.get(key)
+            if lock is None:
+                lock = threading.RLock()
+                self.locks[key] = lock
+            return lock
+
+
+# Lock held shared by any number of threads at once, or exclusive by one. A thread holding it shared can
+# take it shared again, e.g. in nested calls, even while another thread waits for it exclusive. Threads
+# waiting for it exclusive go before threads taking it shared for the first time.
+class SharedLock:
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.shared_count = 0  # threads holding it shared
+        self.exclusive_held = False
+        self.exclusive_waiting = 0
+        self.local = threading.local()  # how often the current thread holds it shared
+
+    @contextmanager
+    def shared(self):
+        depth = getattr(self.local, "depth", 0)
+        if depth == 0:
+            with self.condition:
+                while self.exclusive_held or self.exclusive_waiting:
+                    self.condition.wait()
+                self.shared_count += 1
+        self.local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self.local.depth = depth
+            if depth == 0:
+                with self.condition:
+                    self.shared_count -= 1
+                    if self.shared_count == 0:
+                        self.condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self.condition:
+            self.exclusive_waiting += 1
+            try:
+                while self.exclusive_held or self.shared_count:
+                    self.condition.wait()
+            finally:
+                self.exclusive_waiting -= 1
+            self.exclusive_held = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.exclusive_held = False
+                self.condition.notify_all()
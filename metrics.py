@@ -0,0 +1,166 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Process-wide counters and latency histograms, exposed in Prometheus text format at /metrics. Each process
+# (e.g. each gunicorn worker) keeps its own; Prometheus adds them up across the scraped targets.
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+registry = []  # every metric, in the order they were defined
+
+
+# Monotonic counter with labels
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}  # label values -> count
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *label_values, amount=1) -> None:
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for label_values, value in sorted(values.items()):
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+# Histogram of observed values (seconds) with labels
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # label values -> [count per bucket..., count, sum]
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *label_values) -> None:
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 2)
+                self.values[label_values] = counts
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {label_values: list(counts) for label_values, counts in self.values.items()}
+        for label_values, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (self.name + "_bucket", format_labels(self.labels + ("le",), label_values + (str(bound),)),
+                       cumulative)
+            yield self.name + "_bucket", format_labels(self.labels + ("le",), label_values + ("+Inf",)), counts[-2]
+            yield self.name + "_count", format_labels(self.labels, label_values), counts[-2]
+            yield self.name + "_sum", format_labels(self.labels, label_values), counts[-1]
+
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+# All metrics in Prometheus text exposition format
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value:g}" if isinstance(value, float) else f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# Groups an API URL or path by what is called, e.g. ".../v1/devices/activationCode?orgId=.." -> "activationCode"
+def endpoint(url) -> str:
+    parts = [part for part in urlsplit(url).path.split("/") if part]
+    if "v1" in parts:
+        parts = parts[parts.index("v1") + 1:]
+    if not parts:
+        return "other"
+    if parts[0] == "devices" and parts[1:2] == ["activationCode"]:
+        return "activationCode"
+    if parts[0] == "attachment":
+        return "attachmentActions"
+    if parts[0] in ("workspaces", "memberships", "messages", "people", "webhooks", "devices"):
+        return parts[0]
+    return "other"
+
+
+handler_seconds = Histogram("bot_handler_seconds", "Time spent handling a webhook event.", ("handler",))
+handler_errors = Counter("bot_handler_errors_total", "Webhook handlers that raised an exception.", ("handler",))
+queue_wait_seconds = Histogram("bot_queue_wait_seconds", "Time a webhook event waited in the dispatcher queue.")
+provisioning_seconds = Histogram("bot_provisioning_seconds",
+                                 "Time from a provisioning request to the reply with its codes.", ("kind",))
+api_seconds = Histogram("webex_api_request_seconds", "Latency of a single request to the Webex API.",
+                        ("endpoint", "method"))
+api_errors = Counter("webex_api_errors_total", "Webex API requests answered with an error status or not "
+                     "answered at all.", ("endpoint", "method", "status"))
+api_rate_limited = Counter("webex_api_rate_limited_total", "Webex API requests answered with 429.",
+                           ("endpoint", "method"))
+api_retries = Counter("webex_api_retries_total", "Webex API requests sent again.", ("endpoint", "method", "reason"))
+outbox_replies = Counter("bot_outbox_replies_total", "Replies queued for sending.")
+outbox_posts = Counter("bot_outbox_posts_total", "Messages posted for queued replies, several replies may share one.")
+outbox_failures = Counter("bot_outbox_failures_total", "Messages that could not be sent.")
+outbox_send_seconds = Histogram("bot_outbox_send_seconds", "Time from queueing a reply until it was sent.")
+shard_forwarded = Counter("bot_shard_forwarded_total", "Webhooks forwarded to the node owning their room.",
+                          ("node",))
+shard_forward_failures = Counter("bot_shard_forward_failures_total",
+                                 "Webhooks handled here because the node owning their room could not be reached.",
+                                 ("node",))
+activation_polls = Counter("bot_activation_polls_total", "Device listings checking for activated devices.")
+activations = Counter("bot_device_activations_total", "Devices seen activating with a code the bot sent.")
+throttle_wait_seconds = Counter("webex_throttle_wait_seconds_total",
+                                "Time requests waited for the per-token rate limit.", ("endpoint",))
+
+
+# Records one request to the Webex API. status is None if no response arrived.
+def observe_request(url, method, status, seconds) -> None:
+    group = endpoint(url)
+    api_seconds.observe(seconds, group, method)
+    if status is None:
+        api_errors.inc(group, method, "none")
+    elif status >= 400:
+        api_errors.inc(group, method, str(status))
+        if status == 429:
+            api_rate_limited.inc(group, method)
+
+
+# Times a block and records it in a histogram, e.g. with timer(handler_seconds, "handle_card"): ...
+class timer:
+
+    def __init__(self, histogram, *label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started_at = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.started_at, *self.label_values)
+        return False
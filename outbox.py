@@ -0,0 +1,116 @@
+from __future__ import print_function  # Needed if you want to have console output using Flask
+import asyncio
+import json
+import os
+import time
+from collections import namedtuple
+import aio
+import metrics
+import throttle
+
+OUTBOX_LINGER = float(os.environ.get("OUTBOX_LINGER", 0.05))  # seconds replies to a room wait for more replies
+OUTBOX_RETRIES = int(os.environ.get("OUTBOX_RETRIES", 3))  # sends retried after a server or network error
+MESSAGE_LIMIT = 7000  # longest text put together from several replies, Webex allows a bit more
+
+# A reply waiting to be sent. kind is "text", "markdown" or "card" (a cards.CardMessage with its fields).
+Reply = namedtuple("Reply", ["kind", "content", "fields", "queued_at"])
+
+
+# Sends the bot's replies in the background, so handlers don't wait for them. Replies to a room are sent
+# in order; consecutive texts are put together into one message, cards go out on their own. Runs on the
+# async client.
+class Outbox:
+
+    def __init__(self, token, linger=OUTBOX_LINGER):
+        self.token = token
+        self.linger = linger
+        # only used on the event loop
+        self.pending = {}  # room ID -> replies not sent yet
+        self.flushing = {}  # room ID -> task sending the room's replies
+
+    # Queues a text (or markdown) reply and/or a card. Can be called from any thread.
+    def send(self, room_id, text=None, markdown=None, card=None, **fields) -> None:
+        now = time.monotonic()
+        replies = []
+        if markdown is not None:
+            replies.append(Reply("markdown", markdown, None, now))
+        elif text is not None:
+            replies.append(Reply("text", text, None, now))
+        if card is not None:
+            replies.append(Reply("card", card, fields, now))
+        metrics.outbox_replies.inc(amount=len(replies))
+        aio.get_loop().call_soon_threadsafe(self.enqueue, room_id, replies)
+
+    def enqueue(self, room_id, replies) -> None:
+        self.pending.setdefault(room_id, []).extend(replies)
+        if room_id not in self.flushing:
+            self.flushing[room_id] = asyncio.ensure_future(self.flush(room_id))
+
+    async def flush(self, room_id) -> None:
+        try:
+            while self.pending.get(room_id):
+                # replies queued right after each other go out together
+                await asyncio.sleep(self.linger)
+                for body, queued_ats in coalesce(room_id, self.pending.pop(room_id)):
+                    await self.deliver(room_id, body, queued_ats)
+        finally:
+            del self.flushing[room_id]
+
+    async def deliver(self, room_id, body, queued_ats) -> None:
+        attempt = 0
+        while True:
+            try:
+                response = await aio.post("messages", self.token, data=body)
+            except aio.ERRORS as e:
+                response = None
+                error = repr(e)
+            else:
+                error = response.content[:200]
+            metrics.outbox_posts.inc()
+            if response is not None and response.ok:
+                now = time.monotonic()
+                for queued_at in queued_ats:
+                    metrics.outbox_send_seconds.observe(now - queued_at)
+                return
+            if attempt >= OUTBOX_RETRIES or response is not None and response.status_code < 500:
+                metrics.outbox_failures.inc()
+                print(f"Could not send message to room {room_id}. Response: {error}")
+                return
+            attempt += 1
+            await asyncio.sleep(throttle.backoff(attempt))
+
+    # Waits until every queued reply is sent, e.g. on shutdown
+    def drain(self, timeout=None) -> None:
+        async def wait_idle():
+            while self.flushing:
+                await asyncio.gather(*self.flushing.values(), return_exceptions=True)
+        aio.run(wait_idle(), timeout)
+
+
+# Puts a room's replies together into as few messages as possible, keeping their order.
+# Returns (request body, times the replies in it were queued) per message.
+def coalesce(room_id, replies) -> list:
+    messages = []
+    kind, texts, queued_ats = None, [], []
+    for reply in replies:
+        if reply.kind == "card":
+            # a card's text is only shown by clients that can't show the card, so texts before it go out
+            # as a message of their own
+            if kind is not None:
+                messages.append((message_body(room_id, kind, texts), queued_ats))
+                kind, texts, queued_ats = None, [], []
+            messages.append((reply.content.render(room_id=room_id, **reply.fields), [reply.queued_at]))
+            continue
+        if kind is not None and (reply.kind != kind or sum(map(len, texts)) + len(reply.content) > MESSAGE_LIMIT):
+            messages.append((message_body(room_id, kind, texts), queued_ats))
+            kind, texts, queued_ats = None, [], []
+        kind = reply.kind
+        texts.append(reply.content)
+        queued_ats.append(reply.queued_at)
+    if kind is not None:
+        messages.append((message_body(room_id, kind, texts), queued_ats))
+    return messages
+
+
+def message_body(room_id, kind, texts) -> bytes:
+    return json.dumps({"roomId": room_id, kind: "\n\n".join(texts)}).encode()
@@ -0,0 +1,84 @@
+from __future__ import print_function  # Needed if you want to have console output using Flask
+import os
+from webexteamssdk import ApiError
+from cache import TTLCache, MISSING
+
+PEOPLE_CACHE_SIZE = int(os.environ.get("PEOPLE_CACHE_SIZE", 10000))
+PEOPLE_CACHE_TTL = int(os.environ.get("PEOPLE_CACHE_TTL", 3600))
+PEOPLE_MISS_TTL = 60  # seconds an address is remembered as not being in a room
+BATCH_THRESHOLD = 3  # resolving more unknown addresses than this lists the whole room once
+
+
+# Converts emails to person IDs and back for the members of a room. Results are cached per room, and also
+# learned from incoming webhooks, so repeated commands don't need to ask the API again.
+class PersonResolver:
+
+    def __init__(self, api):
+        self.api = api
+        self.cache = TTLCache(maxsize=PEOPLE_CACHE_SIZE, ttl=PEOPLE_CACHE_TTL)
+
+    # Records a room member, e.g. from a webhook payload
+    def remember(self, room_id, person_id, email) -> None:
+        if person_id and email:
+            self.cache.set((room_id, "email", email.lower()), person_id)
+            self.cache.set((room_id, "id", person_id), email)
+
+    # Returns the person ID for an email, empty if the email is not a member of the room
+    def get_id(self, email, room_id) -> str:
+        return self.get_ids([email], room_id)[email]
+
+    # Returns the email for a person ID, empty if the person is not a member of the room
+    def get_email(self, person_id, room_id) -> str:
+        key = (room_id, "id", person_id)
+        email = self.cache.get(key)
+        if email is MISSING:
+            return ""
+        if email is not None:
+            return email
+        memberships = self.list_memberships(roomId=room_id, personId=person_id)
+        if memberships is None:
+            return ""
+        for membership in memberships:
+            self.remember(room_id, membership.personId, membership.personEmail)
+        if key not in self.cache:
+            self.cache.set(key, MISSING, ttl=PEOPLE_MISS_TTL)
+            return ""
+        return self.cache.get(key)
+
+    # Resolves several emails at once. Returns a dict of email to person ID (empty if not found).
+    def get_ids(self, emails, room_id) -> dict:
+        unknown = [email for email in emails if (room_id, "email", email.lower()) not in self.cache]
+        if len(unknown) > BATCH_THRESHOLD:
+            # one listing of the room is cheaper than a call per address
+            memberships = self.list_memberships(roomId=room_id)
+            if memberships is None:
+                return {email: self.cached_id(email, room_id) for email in emails}
+            for membership in memberships:
+                self.remember(room_id, membership.personId, membership.personEmail)
+            for email in unknown:
+                if (room_id, "email", email.lower()) not in self.cache:
+                    self.cache.set((room_id, "email", email.lower()), MISSING, ttl=PEOPLE_MISS_TTL)
+        else:
+            for email in unknown:
+                memberships = self.list_memberships(roomId=room_id, personEmail=email)
+                if memberships is None:
+                    continue
+                for membership in memberships:
+                    self.remember(room_id, membership.personId, membership.personEmail)
+                if (room_id, "email", email.lower()) not in self.cache:
+                    self.cache.set((room_id, "email", email.lower()), MISSING, ttl=PEOPLE_MISS_TTL)
+        return {email: self.cached_id(email, room_id) for email in emails}
+
+    def cached_id(self, email, room_id) -> str:
+        person_id = self.cache.get((room_id, "email", email.lower()))
+        if person_id is None or person_id is MISSING:
+            return ""
+        return person_id
+
+    # Lists memberships, None if the API call failed
+    def list_memberships(self, **parameters):
+        try:
+            return list(self.api.memberships.list(**parameters))
+        except ApiError as e:
+            print(f"Could not list memberships: {e}")
+            return None
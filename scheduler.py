@@ -0,0 +1,96 @@
+from __future__ import print_function  # Needed if you want to have console output using Flask
+import asyncio
+import hashlib
+import os
+import threading
+import time
+import aio
+from admin import TOKEN_CHECK_TTL
+
+# seconds between token checks, shorter than TOKEN_CHECK_TTL so requests always find a recent result
+TOKEN_CHECK_INTERVAL = float(os.environ.get("TOKEN_CHECK_INTERVAL", TOKEN_CHECK_TTL * 0.8))
+TOKEN_CHECK_WORKERS = int(os.environ.get("TOKEN_CHECK_WORKERS", 8))  # tokens checked at the same time
+# personal access tokens expire 12 hours after they were issued. 0 turns off the warnings before expiry.
+TOKEN_LIFETIME = float(os.environ.get("TOKEN_LIFETIME", 12 * 3600))
+TOKEN_WARN_BEFORE = float(os.environ.get("TOKEN_WARN_BEFORE", 3600))  # seconds before expiry rooms are warned
+
+
+# Checks the admins' tokens in the background, so requests are answered from a recent check instead of
+# checking first. Rooms whose token was rejected are asked to reinitialize right away, rooms whose token
+# is about to expire are warned ahead of time.
+class TokenScheduler:
+
+    def __init__(self, bot, interval=TOKEN_CHECK_INTERVAL):
+        self.bot = bot
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, name="token-scheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                print(f"Token check failed: {e!r}")
+
+    # Checks every admin's token once and prompts the rooms of rejected and expiring tokens. With several
+    # processes sharing the store, only one of them (per node, if sharded) runs each round.
+    def check(self) -> None:
+        if not self.claim_round():
+            return
+        self.bot.sync()
+        admins = list(self.bot.admins.values())
+        if not admins:
+            return
+        started_at = time.monotonic()
+        aio.run(self.check_tokens(admins), timeout=self.interval)
+        now = time.time()
+        rejected = 0
+        for admin in admins:
+            if admin.token_checked_at is None or admin.token_checked_at < started_at:
+                continue  # check inconclusive, e.g. Webex unavailable. Try again next time
+            if not admin.token_valid:
+                rejected += 1
+                if self.claim_prompt(admin, "rejected"):
+                    self.bot.drop_admin(admin)
+            elif TOKEN_LIFETIME and admin.token_set_at is not None:
+                expires_in = admin.token_set_at + TOKEN_LIFETIME - now
+                if expires_in < TOKEN_WARN_BEFORE and self.claim_prompt(admin, "expiring"):
+                    self.warn(admin, expires_in)
+        print(f"Checked {len(admins)} tokens in {time.monotonic() - started_at:.1f}s, {rejected} rejected.")
+
+    async def check_tokens(self, admins) -> None:
+        semaphore = asyncio.Semaphore(TOKEN_CHECK_WORKERS)
+
+        async def check_token(admin):
+            async with semaphore:
+                await admin.aio.token_is_valid(force=True)
+
+        await asyncio.gather(*(check_token(admin) for admin in admins))
+
+    # Claims this interval's round. The claim ends a little before the next round, so the process that ran
+    # this one usually runs the next one too.
+    def claim_round(self) -> bool:
+        return self.bot.store.claim(f"token_check:{self.bot.cluster.self_url}", self.interval * 0.9)
+
+    # Makes sure a token is only prompted about once, also across processes sharing the store
+    def claim_prompt(self, admin, kind) -> bool:
+        digest = hashlib.sha256(admin.my_token.encode()).hexdigest()[:16]
+        return self.bot.store.claim(f"token:{kind}:{admin.org_id}:{digest}", max(TOKEN_LIFETIME, self.interval))
+
+    # Sends the init card after the warning, so a new token can be entered right away
+    def warn(self, admin, expires_in) -> None:
+        minutes = max(0, int(expires_in // 60))
+        for room in self.bot.rooms_of(admin):
+            self.bot.outbox.send(room, text=f"The access token used in this space expires in about {minutes} minutes. "
+                                            f"Please fill out the card below with a new token to keep provisioning.")
+            self.bot.send_card(room, self.bot.init_card)
@@ -0,0 +1,141 @@
+from __future__ import print_function  # Needed if you want to have console output using Flask
+import bisect
+import hashlib
+import ipaddress
+import json
+import os
+import socket
+import threading
+from urllib.parse import urlparse
+import requests
+
+# Sharded deployment: several nodes (processes running app.py) share the store, and every room belongs to
+# one of them by consistent hashing of its org's ID, so all rooms of an org share one node. Webex may deliver
+# a webhook to any node; a node that doesn't own the room forwards it to the owner, so each org's admins,
+# token checks and caches live on one node only. Nodes on several machines share the store through
+# store_server.py; a SQLite file only works for processes on the same host, so with one every node must run
+# on this host. Without SHARD_NODES every room belongs to this node.
+SHARD_NODES = os.environ.get("SHARD_NODES", "")  # comma separated base URLs of all nodes, e.g. http://10.0.0.2:5000
+SHARD_SELF = os.environ.get("SHARD_SELF", "")  # base URL of this node, as listed in SHARD_NODES
+SHARD_REPLICAS = int(os.environ.get("SHARD_REPLICAS", 100))  # points per node on the ring, evens out the shares
+FORWARD_TIMEOUT = float(os.environ.get("FORWARD_TIMEOUT", 5))  # seconds to wait for the owner to take an event
+FORWARDED_HEADER = "X-Shard-Forwarded-By"  # set on forwarded webhooks, they are never forwarded again
+NODES_SETTING = "shard_nodes"  # store setting with the current nodes, as a JSON list
+
+
+# Consistent hash ring. Adding or removing a node only moves the keys of that node's points, about
+# 1/len(nodes) of them, the others keep their owner.
+class HashRing:
+
+    def __init__(self, nodes=(), replicas=SHARD_REPLICAS):
+        self.nodes = sorted(set(nodes))
+        self.points = []  # sorted hashes of the nodes' points
+        self.owners = []  # node of each point
+        for hash_value, node in sorted((point_hash(f"{node}#{replica}"), node)
+                                       for node in self.nodes for replica in range(replicas)):
+            self.points.append(hash_value)
+            self.owners.append(node)
+
+    # The node owning a key, None if the ring is empty
+    def node_for(self, key):
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, point_hash(key)) % len(self.points)
+        return self.owners[index]
+
+
+# md5 spreads similar keys (e.g. node URLs differing in the port) more evenly than crc32
+def point_hash(key) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+# Raises ValueError for nodes not running on this host, they could not share a SQLite store
+def check_local(nodes) -> None:
+    remote = [node for node in nodes if not is_local(node)]
+    if remote:
+        raise ValueError(f"Nodes must run on this host, as they share the store file: {', '.join(remote)}")
+
+
+# True if the URL's host is a loopback address or one of this host's
+def is_local(url) -> bool:
+    try:
+        address = ipaddress.ip_address(socket.gethostbyname(urlparse(url).hostname or ""))
+        return address.is_loopback or str(address) == socket.gethostbyname(socket.gethostname())
+    except (OSError, ValueError):
+        return False
+
+
+# This node's view of the cluster. The nodes are kept in the store; a change made through one node's
+# /cluster route is announced to the others, and nodes that missed it pick it up when they next sync with
+# the store. local_only is set if the store can't be shared across machines.
+class Cluster:
+
+    def __init__(self, nodes=None, self_url=SHARD_SELF, local_only=True):
+        if nodes is None:
+            nodes = [node.strip().rstrip("/") for node in SHARD_NODES.split(",") if node.strip()]
+        self.local_only = local_only
+        self.check(nodes)
+        self.self_url = self_url.rstrip("/")
+        self.ring = HashRing(nodes)
+        self.session = requests.Session()  # connections to the other nodes are kept open
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.ring.nodes)
+
+    @property
+    def nodes(self) -> list:
+        return self.ring.nodes
+
+    # The node owning a room: the one of its org, or for a room without an org yet the one of its ID
+    def owner(self, room_id, org_id=None) -> str:
+        return self.ring.node_for(org_id or room_id) or self.self_url
+
+    def owns(self, room_id, org_id=None) -> bool:
+        return not self.enabled or self.owner(room_id, org_id) == self.self_url
+
+    # Takes the nodes saved in the store, if any. Returns True if they changed.
+    def load(self, data) -> bool:
+        if not data.get(NODES_SETTING):
+            return False
+        return self.set_nodes(json.loads(data[NODES_SETTING]))
+
+    # Raises ValueError for nodes that can't share the store, see check()
+    def set_nodes(self, nodes) -> bool:
+        nodes = sorted({node.rstrip("/") for node in nodes})
+        self.check(nodes)
+        with self.lock:
+            if nodes == self.ring.nodes:
+                return False
+            self.ring = HashRing(nodes)
+        print(f"Cluster nodes: {', '.join(nodes) or 'none'}.")
+        return True
+
+    # Raises ValueError if the store is local and a node is not on this host
+    def check(self, nodes) -> None:
+        if self.local_only:
+            check_local(nodes)
+
+    # Tells the other nodes, including any that just left, to load the nodes from the store again after
+    # they were changed here
+    def announce(self, nodes, secret) -> None:
+        for node in sorted(nodes):
+            if node == self.self_url:
+                continue
+            try:
+                self.session.post(node + "/cluster", json={"reload": True}, timeout=FORWARD_TIMEOUT,
+                                  headers={"X-Cluster-Secret": secret}).raise_for_status()
+            except requests.RequestException as e:
+                print(f"Could not tell {node} about the new nodes, it picks them up later: {e!r}")
+
+    # Sends a webhook to the node owning its room. Returns (body, status) of the owner's answer, or None if
+    # the owner could not be reached.
+    def forward(self, owner, path, body, headers):
+        try:
+            response = self.session.post(owner + path, data=body, timeout=FORWARD_TIMEOUT,
+                                         headers=dict(headers, **{FORWARDED_HEADER: self.self_url}))
+        except requests.RequestException as e:
+            print(f"Could not forward event to {owner}: {e!r}")
+            return None
+        return response.content, response.status_code
@@ -0,0 +1,357 @@
+from __future__ import print_function  # Needed if you want to have console output using Flask
+import json
+import os
+import sqlite3
+import threading
+import time
+import requests
+
+STORE_SECRET = os.environ.get("STORE_SECRET")  # shared with store_server.py, sent with every call to it
+STORE_TIMEOUT = float(os.environ.get("STORE_TIMEOUT", 10))  # seconds to wait for store_server.py
+
+
+# Persists the bot's state. Every mutation is written right away, so nothing is lost if the bot crashes.
+# This base class keeps nothing and can be used when no persistence is wanted.
+class Store:
+
+    shared_across_hosts = False  # True if processes on other machines can use the same store
+
+    # Returns the saved state in the same format as the old bot_data.json
+    def load(self) -> dict:
+        return empty_data()
+
+    def save_setting(self, key, value) -> None:
+        pass
+
+    def save_org(self, org_id) -> None:
+        pass
+
+    def save_allowed_user(self, org_id, user_id, email) -> None:
+        pass
+
+    def delete_allowed_user(self, org_id, user_id) -> None:
+        pass
+
+    def save_room(self, room_id, org_id) -> None:
+        pass
+
+    def delete_room(self, room_id) -> None:
+        pass
+
+    # token_set_at is when the token was given to the bot (seconds since the epoch), None if unknown
+    def save_admin(self, room_id, admin_token, org_id, token_set_at=None) -> None:
+        pass
+
+    def delete_admin(self, room_id) -> None:
+        pass
+
+    # Sets a new token for every room of an org
+    def save_org_token(self, org_id, admin_token, token_set_at=None) -> None:
+        pass
+
+    def is_empty(self) -> bool:
+        return True
+
+    # Changes whenever another process wrote to the store, so it knows to load the state again
+    def data_version(self) -> int:
+        return 0
+
+    # Claims a name for ttl seconds. Returns False if another process (or an earlier call) holds the claim.
+    # Used to do things once across all processes sharing the store.
+    def claim(self, name, ttl) -> bool:
+        return True
+
+    def release(self, name) -> None:
+        pass
+
+    # Writes a whole state as returned by load(), e.g. from an old bot_data.json
+    def import_data(self, data) -> None:
+        for key in ("bot_name", "bot_token", "bot_email"):
+            if data.get(key):
+                self.save_setting(key, data[key])
+        for org_id in known_orgs(data):
+            self.save_org(org_id)
+        for org_id, user_ids in data.get("org_allowed_users", {}).items():
+            emails = data.get("org_id_to_email", {}).get(org_id, {})
+            for user_id in user_ids:
+                self.save_allowed_user(org_id, user_id, emails.get(user_id, ""))
+        for room_id, org_id in data.get("room_to_org", {}).items():
+            self.save_room(room_id, org_id)
+        for room_id, admin in data.get("admin_data", {}).items():
+            self.save_admin(room_id, admin["admin_token"], admin["org_id"], admin.get("token_set_at"))
+
+    def close(self) -> None:
+        pass
+
+
+# Default store. Uses SQLite in WAL mode, so writes are cheap appends and readers don't block writers.
+# Claims are kept in a database file of their own (see claims_path()): one is written for every webhook,
+# and in the state's file each of them would make every other process reload the whole state.
+class SQLiteStore(Store):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = connect(path)
+        self.claims_lock = threading.Lock()
+        self.claims_connection = connect(claims_path(path))
+        with self.claims_connection:
+            self.claims_connection.execute("CREATE TABLE IF NOT EXISTS claims (name TEXT PRIMARY KEY, expires_at REAL)")
+        with self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS orgs (org_id TEXT PRIMARY KEY);
+                CREATE TABLE IF NOT EXISTS allowed_users (
+                    org_id TEXT, user_id TEXT, email TEXT, PRIMARY KEY (org_id, user_id));
+                CREATE TABLE IF NOT EXISTS rooms (room_id TEXT PRIMARY KEY, org_id TEXT);
+                CREATE TABLE IF NOT EXISTS admins (room_id TEXT PRIMARY KEY, admin_token TEXT, org_id TEXT);
+                DROP TABLE IF EXISTS claims;
+            """)
+            # added later, stores created before don't have it
+            if "token_set_at" not in [column[1] for column in self.connection.execute("PRAGMA table_info(admins)")]:
+                self.connection.execute("ALTER TABLE admins ADD COLUMN token_set_at REAL")
+        self.claims = 0
+
+    # Runs one statement in its own transaction
+    def execute(self, statement, parameters=()) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(statement, parameters)
+
+    def query(self, statement, parameters=()) -> list:
+        with self.lock:
+            return self.connection.execute(statement, parameters).fetchall()
+
+    def load(self) -> dict:
+        data = empty_data()
+        for key, value in self.query("SELECT key, value FROM settings"):
+            data[key] = value
+        data["orgs"] = [org_id for org_id, in self.query("SELECT org_id FROM orgs")]
+        for org_id, user_id, email in self.query("SELECT org_id, user_id, email FROM allowed_users"):
+            data["org_allowed_users"].setdefault(org_id, []).append(user_id)
+            data["org_id_to_email"].setdefault(org_id, {})[user_id] = email
+        data["room_to_org"] = dict(self.query("SELECT room_id, org_id FROM rooms"))
+        for room_id, admin_token, org_id, token_set_at in self.query(
+                "SELECT room_id, admin_token, org_id, token_set_at FROM admins"):
+            data["admin_data"][room_id] = {"admin_token": admin_token, "org_id": org_id, "token_set_at": token_set_at}
+        return data
+
+    def save_setting(self, key, value) -> None:
+        self.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+    def save_org(self, org_id) -> None:
+        self.execute("INSERT OR IGNORE INTO orgs (org_id) VALUES (?)", (org_id,))
+
+    def save_allowed_user(self, org_id, user_id, email) -> None:
+        self.execute("INSERT OR REPLACE INTO allowed_users (org_id, user_id, email) VALUES (?, ?, ?)",
+                     (org_id, user_id, email))
+
+    def delete_allowed_user(self, org_id, user_id) -> None:
+        self.execute("DELETE FROM allowed_users WHERE org_id = ? AND user_id = ?", (org_id, user_id))
+
+    def save_room(self, room_id, org_id) -> None:
+        self.execute("INSERT OR REPLACE INTO rooms (room_id, org_id) VALUES (?, ?)", (room_id, org_id))
+
+    def delete_room(self, room_id) -> None:
+        self.execute("DELETE FROM rooms WHERE room_id = ?", (room_id,))
+
+    def save_admin(self, room_id, admin_token, org_id, token_set_at=None) -> None:
+        self.execute("INSERT OR REPLACE INTO admins (room_id, admin_token, org_id, token_set_at) VALUES (?, ?, ?, ?)",
+                     (room_id, admin_token, org_id, token_set_at))
+
+    def delete_admin(self, room_id) -> None:
+        self.execute("DELETE FROM admins WHERE room_id = ?", (room_id,))
+
+    def save_org_token(self, org_id, admin_token, token_set_at=None) -> None:
+        self.execute("UPDATE admins SET admin_token = ?, token_set_at = ? WHERE org_id = ?",
+                     (admin_token, token_set_at, org_id))
+
+    def is_empty(self) -> bool:
+        return not any(self.query(f"SELECT 1 FROM {table} LIMIT 1")
+                       for table in ("orgs", "allowed_users", "rooms", "admins"))
+
+    def data_version(self) -> int:
+        return self.query("PRAGMA data_version")[0][0]
+
+    def claim(self, name, ttl) -> bool:
+        now = time.time()
+        with self.claims_lock, self.claims_connection:
+            cursor = self.claims_connection.execute(
+                "INSERT INTO claims (name, expires_at) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET expires_at = excluded.expires_at WHERE claims.expires_at <= ?",
+                (name, now + ttl, now))
+            self.claims += 1
+            if self.claims % 1000 == 0:
+                self.claims_connection.execute("DELETE FROM claims WHERE expires_at <= ?", (now,))
+            return cursor.rowcount == 1
+
+    def release(self, name) -> None:
+        with self.claims_lock, self.claims_connection:
+            self.claims_connection.execute("DELETE FROM claims WHERE name = ?", (name,))
+
+    def import_data(self, data) -> None:
+        # imported in one transaction instead of one per row
+        settings = [(key, data[key]) for key in ("bot_name", "bot_token", "bot_email") if data.get(key)]
+        emails = data.get("org_id_to_email", {})
+        allowed_users = [(org_id, user_id, emails.get(org_id, {}).get(user_id, ""))
+                         for org_id, user_ids in data.get("org_allowed_users", {}).items() for user_id in user_ids]
+        admins = [(room_id, admin["admin_token"], admin["org_id"], admin.get("token_set_at"))
+                  for room_id, admin in data.get("admin_data", {}).items()]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", settings)
+            self.connection.executemany("INSERT OR IGNORE INTO orgs (org_id) VALUES (?)",
+                                        [(org_id,) for org_id in known_orgs(data)])
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO allowed_users (org_id, user_id, email) VALUES (?, ?, ?)", allowed_users)
+            self.connection.executemany("INSERT OR REPLACE INTO rooms (room_id, org_id) VALUES (?, ?)",
+                                        list(data.get("room_to_org", {}).items()))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO admins (room_id, admin_token, org_id, token_set_at) VALUES (?, ?, ?, ?)", admins)
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+        with self.claims_lock:
+            self.claims_connection.close()
+
+
+def connect(path) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+# The claims' database file next to the state's, e.g. bot_data.claims.db for bot_data.db
+def claims_path(path) -> str:
+    if path == ":memory:":
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.claims{extension}"
+
+
+# Store served by store_server.py, so processes on several machines (e.g. the nodes of a sharded deployment)
+# share the state. Every call is one HTTP request. The server counts the changes to the state; the ones made
+# through this store are left out of data_version(), like SQLite does for a connection's own writes.
+class RemoteStore(Store):
+
+    shared_across_hosts = True
+
+    def __init__(self, url, secret=STORE_SECRET):
+        self.url = url.rstrip("/") + "/call"
+        self.headers = {"X-Store-Secret": secret or ""}
+        self.session = requests.Session()  # the connection to the server is kept open
+        self.own_changes = 0
+        self.lock = threading.Lock()
+
+    # Calls a method of the served store. Raises requests.RequestException if the server can't be reached
+    # or refuses the call.
+    def call(self, method, *args):
+        response = self.session.post(self.url, json={"method": method, "args": args}, headers=self.headers,
+                                     timeout=STORE_TIMEOUT)
+        response.raise_for_status()
+        return response.json()["result"]
+
+    def change(self, method, *args) -> None:
+        self.call(method, *args)
+        with self.lock:
+            self.own_changes += 1
+
+    def load(self) -> dict:
+        return self.call("load")
+
+    def save_setting(self, key, value) -> None:
+        self.change("save_setting", key, value)
+
+    def save_org(self, org_id) -> None:
+        self.change("save_org", org_id)
+
+    def save_allowed_user(self, org_id, user_id, email) -> None:
+        self.change("save_allowed_user", org_id, user_id, email)
+
+    def delete_allowed_user(self, org_id, user_id) -> None:
+        self.change("delete_allowed_user", org_id, user_id)
+
+    def save_room(self, room_id, org_id) -> None:
+        self.change("save_room", room_id, org_id)
+
+    def delete_room(self, room_id) -> None:
+        self.change("delete_room", room_id)
+
+    def save_admin(self, room_id, admin_token, org_id, token_set_at=None) -> None:
+        self.change("save_admin", room_id, admin_token, org_id, token_set_at)
+
+    def delete_admin(self, room_id) -> None:
+        self.change("delete_admin", room_id)
+
+    def save_org_token(self, org_id, admin_token, token_set_at=None) -> None:
+        self.change("save_org_token", org_id, admin_token, token_set_at)
+
+    def is_empty(self) -> bool:
+        return self.call("is_empty")
+
+    def data_version(self) -> int:
+        with self.lock:
+            own_changes = self.own_changes
+        return self.call("data_version") - own_changes
+
+    def claim(self, name, ttl) -> bool:
+        return self.call("claim", name, ttl)
+
+    def release(self, name) -> None:
+        self.call("release", name)
+
+    def import_data(self, data) -> None:
+        self.change("import_data", data)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+def empty_data() -> dict:
+    data = {
+        "bot_name": None,
+        "bot_token": None,
+        "bot_email": None,
+        "orgs": [],
+        "admin_data": {},
+        "org_allowed_users": {},
+        "room_to_org": {},
+        "org_id_to_email": {}
+    }
+    return data
+
+
+# Orgs of a saved state. Older bot_data.json files left "orgs" empty, so orgs are also taken from users and rooms.
+def known_orgs(data) -> list:
+    orgs = list(data.get("orgs", [])) + list(data.get("org_allowed_users", {})) + list(data.get("room_to_org", {}).values())
+    return list(dict.fromkeys(orgs))
+
+
+# Imports an old bot_data.json into an empty store once. The file is renamed afterwards so it isn't imported again.
+def import_json(store, path="bot_data.json") -> bool:
+    if not os.path.exists(path) or not store.is_empty():
+        return False
+    try:
+        with open(path) as file:
+            data = json.load(file)
+    except FileNotFoundError:
+        # imported by another process in the meantime
+        return False
+    store.import_data(data)
+    try:
+        os.replace(path, path + ".imported")
+    except FileNotFoundError:
+        # another process imported the same file at the same time, importing twice does no harm
+        pass
+    print(f"Imported {path} into the store.")
+    return True
+
+
+# Opens the store at path, a SQLite database, or the URL of a store_server.py. "none" keeps the state in
+# memory only.
+def open_store(path) -> Store:
+    if path == "none":
+        return Store()
+    if path.startswith(("http://", "https://")):
+        return RemoteStore(path)
+    return SQLiteStore(path)
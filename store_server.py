@@ -0,0 +1,63 @@
+from __future__ import print_function  # Needed if you want to have console output using Flask
+import hmac
+import os
+import threading
+import time
+from flask import Flask, request, jsonify
+from store import open_store, STORE_SECRET
+
+# Serves the bot's store to bot processes on other machines (see store.RemoteStore), e.g. the nodes of a
+# sharded deployment. Start it where the SQLite file lives and point the nodes' BOT_STORE at its URL:
+#   STORE_SECRET=... BOT_STORE=bot_data.db python3 store_server.py
+STORE_PATH = os.environ.get("BOT_STORE", "bot_data.db")  # the SQLite file served
+STORE_PORT = os.environ.get("STORE_PORT", 5050)
+
+# Store methods the nodes may call. The ones changing the state change the version the nodes compare to
+# know when to reload it, claims don't.
+CHANGES = {"save_setting", "save_org", "save_allowed_user", "delete_allowed_user", "save_room", "delete_room",
+           "save_admin", "delete_admin", "save_org_token", "import_data"}
+READS = {"load", "is_empty", "claim", "release"}
+
+
+# Counts the changes to the state. Starts from the time, so nodes reload the state after a restart.
+class Version:
+
+    def __init__(self):
+        self.value = time.time_ns()
+        self.lock = threading.Lock()
+
+    def bump(self) -> int:
+        with self.lock:
+            self.value += 1
+            return self.value
+
+
+def create_app(store=None, secret=STORE_SECRET) -> Flask:
+    if not secret:
+        raise ValueError("STORE_SECRET must be set, the store holds the orgs' access tokens")
+    store = store if store is not None else open_store(STORE_PATH)
+    version = Version()
+    app = Flask(__name__)
+
+    @app.route("/call", methods=['POST'])
+    def call():
+        if not hmac.compare_digest(request.headers.get("X-Store-Secret", ""), secret):
+            return 'forbidden', 403
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get("args", []), list):
+            return 'bad request', 400
+        method, args = body.get("method"), body.get("args", [])
+        if method == "data_version":
+            return jsonify({"result": version.value})
+        if method not in CHANGES and method not in READS:
+            return 'bad request', 400
+        result = getattr(store, method)(*args)
+        if method in CHANGES:
+            version.bump()
+        return jsonify({"result": result})
+
+    return app
+
+
+if __name__ == "__main__":
+    create_app().run(host="0.0.0.0", port=STORE_PORT, threaded=True)
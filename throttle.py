@@ -0,0 +1,68 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from cache import TTLCache
+
+BUCKETS = 10000  # most token buckets kept, the least recently used go first
+BUCKET_IDLE_TTL = 3600  # seconds an unused bucket is kept, by then it is full again anyway
+
+
+# Token bucket limiting how fast requests are sent with one access token. Callers that exceed the budget
+# are queued (they wait for their slot) instead of failing. pause() holds back everyone, e.g. on a 429.
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate  # requests per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    # Takes a token and returns how many seconds the caller has to wait before using it
+    def reserve(self) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+
+    def pause(self, seconds) -> None:
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+buckets = TTLCache(maxsize=BUCKETS, ttl=BUCKET_IDLE_TTL)  # one bucket per access token in use
+buckets_lock = threading.Lock()
+
+
+def get_bucket(key, rate, burst) -> TokenBucket:
+    with buckets_lock:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+        buckets.set(key, bucket)  # kept for another BUCKET_IDLE_TTL seconds
+        return bucket
+
+
+# Seconds to wait according to a Retry-After header (in seconds or as a date), or default if there is none
+def retry_after(headers, default=1.0) -> float:
+    value = headers.get("Retry-After")
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+# Exponential backoff with full jitter for the given retry attempt (starting at 0)
+def backoff(attempt, base=0.5, cap=30.0) -> float:
+    return random.uniform(0, min(cap, base * 2 ** attempt))
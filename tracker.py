@@ -0,0 +1,143 @@
+from __future__ import print_function  # Needed if you want to have console output using Flask
+import asyncio
+import os
+import time
+from datetime import datetime
+import aio
+import metrics
+import workspaces
+from admin import get_code_cache, get_workspace_cache
+
+ACTIVATION_POLL_MIN = float(os.environ.get("ACTIVATION_POLL_MIN", 30))  # seconds between polls after a change
+ACTIVATION_POLL_MAX = float(os.environ.get("ACTIVATION_POLL_MAX", 600))  # longest wait while nothing activates
+ACTIVATION_CODE_LIFETIME = float(os.environ.get("ACTIVATION_CODE_LIFETIME", 7 * 24 * 3600))  # codes expire after
+DEVICE_PAGE_SIZE = int(os.environ.get("DEVICE_PAGE_SIZE", 1000))  # devices per listing request
+CLOCK_SKEW = 60  # seconds a device may seem to be created before its code was issued
+
+
+# A code waiting for a device to activate with it
+class PendingCode:
+
+    def __init__(self, workspace_name, room_id, issued_at):
+        self.workspace_name = workspace_name
+        self.room_id = room_id
+        self.issued_at = issued_at  # epoch seconds
+        self.expires_at = issued_at + ACTIVATION_CODE_LIFETIME
+
+
+# Codes of one org waiting for their devices, polled together
+class OrgCodes:
+
+    def __init__(self, admin):
+        self.admin = admin  # the latest admin that issued a code, its token is used to poll
+        self.pending = {}  # workspace ID -> PendingCode
+        self.interval = ACTIVATION_POLL_MIN
+        self.next_poll_at = time.monotonic() + ACTIVATION_POLL_MIN
+        self.woken = asyncio.Event()  # set when a code is issued, the next poll may be sooner
+        self.task = None
+
+
+# Tells rooms when a device activated with a code the bot sent them. Each org with outstanding codes is
+# polled by one task, with one device listing covering all of its workspaces, so polling costs grow with the
+# orgs, not the codes. The interval starts at ACTIVATION_POLL_MIN and doubles up to ACTIVATION_POLL_MAX while
+# nothing activates. A code stops being tracked when its device activates or the code expires. Runs on the
+# async client, the codes are kept in memory only.
+class ActivationTracker:
+
+    def __init__(self, outbox):
+        self.outbox = outbox
+        self.orgs = {}  # org ID -> OrgCodes, only used on the event loop
+
+    # Starts tracking codes issued for workspaces. Must be called on the event loop, e.g. from provisioning.
+    def track(self, admin, room_id, workspace_names) -> None:
+        workspace_cache = get_workspace_cache(admin.org_id)
+        code_cache = get_code_cache(admin.org_id)
+        index = workspaces.get_index(admin.org_id)
+        org = self.orgs.get(admin.org_id)
+        if org is None:
+            org = self.orgs[admin.org_id] = OrgCodes(admin)
+        org.admin = admin
+        now = time.time()
+        for workspace_name in workspace_names:
+            workspace_id = workspace_cache.get(workspace_name)
+            if not isinstance(workspace_id, str):
+                workspace_id = index.get_id(workspace_name)
+            if not workspace_id:
+                continue
+            if workspace_id in org.pending:
+                org.pending[workspace_id].room_id = room_id  # the same code handed out again
+                continue
+            # a code handed out again is waited for since it was first issued
+            issued = code_cache.get((workspace_name, None))
+            org.pending[workspace_id] = PendingCode(workspace_name, room_id, issued[1] if issued else now)
+        if not org.pending:
+            return
+        org.interval = ACTIVATION_POLL_MIN
+        org.next_poll_at = min(org.next_poll_at, time.monotonic() + ACTIVATION_POLL_MIN)
+        org.woken.set()
+        if org.task is None or org.task.done():
+            org.task = asyncio.ensure_future(self.watch(admin.org_id, org))
+
+    async def watch(self, org_id, org) -> None:
+        try:
+            while org.pending:
+                org.woken.clear()
+                delay = org.next_poll_at - time.monotonic()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(org.woken.wait(), delay)
+                        continue  # a code was issued, the next poll may be sooner
+                    except asyncio.TimeoutError:
+                        pass
+                activated = await self.poll(org_id, org)
+                org.interval = ACTIVATION_POLL_MIN if activated else min(org.interval * 2, ACTIVATION_POLL_MAX)
+                org.next_poll_at = time.monotonic() + org.interval
+        finally:
+            if self.orgs.get(org_id) is org and not org.pending:
+                del self.orgs[org_id]
+
+    # Checks the org's pending workspaces for devices once. Returns how many activated.
+    async def poll(self, org_id, org) -> int:
+        now = time.time()
+        for workspace_id, code in list(org.pending.items()):
+            if code.expires_at <= now:
+                print(f"Activation code for workspace {code.workspace_name} expired unused.")
+                del org.pending[workspace_id]
+        if not org.pending:
+            return 0
+        # a single workspace is asked about directly, else all of the org's devices are listed at once
+        params = {"orgId": org_id, "max": DEVICE_PAGE_SIZE}
+        if len(org.pending) == 1:
+            params["workspaceId"] = next(iter(org.pending))
+        metrics.activation_polls.inc()
+        devices = await list_devices(org.admin.my_token, params)
+        if devices is None:
+            return 0
+        activated = 0
+        for device in devices:
+            code = org.pending.get(device.get("workspaceId"))
+            if code is None or created_at(device) < code.issued_at - CLOCK_SKEW:
+                continue  # not waited for, or there before the code
+            del org.pending[device["workspaceId"]]
+            # the code is used up, the next request for the workspace gets a new one
+            get_code_cache(org_id).delete((code.workspace_name, None))
+            activated += 1
+            metrics.activations.inc()
+            self.outbox.send(code.room_id, text=f"{device.get('displayName') or 'A device'} is now activated in "
+                                                f"workspace {code.workspace_name}.")
+        if activated:
+            print(f"{activated} devices activated in org {org_id}, waiting for {len(org.pending)} more.")
+        return activated
+
+
+# Devices matching the parameters, following the listing's pages. None if they could not be listed.
+async def list_devices(token, params):
+    return await aio.list_items("devices", token, params)
+
+
+# When a device was created (activated), in epoch seconds. Devices without a known time count as new.
+def created_at(device) -> float:
+    try:
+        return datetime.fromisoformat(device["created"].replace("Z", "+00:00")).timestamp()
+    except (KeyError, AttributeError, ValueError):
+        return float("inf")
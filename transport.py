@@ -0,0 +1,99 @@
+from __future__ import print_function  # Needed if you want to have console output using Flask
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from webexteamssdk import WebexTeamsAPI
+import metrics
+import throttle
+from cache import TTLCache
+
+# Process-wide HTTP transport to the Webex API. All Admins and the Bot share one connection pool, so
+# connections to webexapis.com are kept alive and reused instead of doing a full TLS handshake per call.
+API_URL = os.environ.get("WEBEX_API_URL", "https://webexapis.com/v1/")
+POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 20))
+CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 30))
+RETRIES = int(os.environ.get("HTTP_RETRIES", 3))
+RATE_LIMIT = float(os.environ.get("RATE_LIMIT", 5))  # requests per second per access token
+RATE_BURST = int(os.environ.get("RATE_BURST", 10))
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+API_CLIENTS = int(os.environ.get("API_CLIENTS", 1000))  # most SDK clients kept, one per access token
+API_CLIENT_IDLE_TTL = 3600  # seconds an unused SDK client is kept
+
+
+# Adapter throttling requests per access token. 429s are retried after Retry-After (holding back every
+# request with that token meanwhile) and 5xx on idempotent requests are retried with jittered backoff,
+# so bursts turn into some extra latency instead of errors.
+class ThrottledAdapter(HTTPAdapter):
+
+    def send(self, request, **kwargs):
+        bucket = throttle.get_bucket(request.headers.get("Authorization", ""), RATE_LIMIT, RATE_BURST)
+        endpoint = metrics.endpoint(request.url)
+        attempt = 0
+        while True:
+            wait = bucket.reserve()
+            if wait > 0:
+                metrics.throttle_wait_seconds.inc(endpoint, amount=wait)
+                time.sleep(wait)
+            started_at = time.monotonic()
+            try:
+                response = super().send(request, **kwargs)
+            except requests.RequestException:
+                metrics.observe_request(request.url, request.method, None, time.monotonic() - started_at)
+                raise
+            metrics.observe_request(request.url, request.method, response.status_code, time.monotonic() - started_at)
+            if attempt >= RETRIES:
+                return response
+            if response.status_code == 429:
+                wait = throttle.retry_after(response.headers)
+                print(f"Rate limited on {request.path_url}. Retrying in {wait:.1f}s.")
+                metrics.api_retries.inc(endpoint, request.method, "429")
+                bucket.pause(wait)
+            elif response.status_code >= 500 and request.method in IDEMPOTENT_METHODS:
+                wait = throttle.backoff(attempt)
+                print(f"Server error {response.status_code} on {request.path_url}. Retrying in {wait:.1f}s.")
+                metrics.api_retries.inc(endpoint, request.method, "5xx")
+                time.sleep(wait)
+            else:
+                return response
+            response.close()
+            attempt += 1
+
+
+def make_adapter() -> HTTPAdapter:
+    # urllib3 only retries connection problems, responses are retried by the ThrottledAdapter
+    retry = Retry(total=RETRIES, backoff_factor=0.5, status_forcelist=(), raise_on_status=False)
+    return ThrottledAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+
+
+adapter = make_adapter()
+
+# one SDK client per access token. Tokens come and go (personal ones expire after 12 hours), so clients not
+# asked for in a while are dropped; an admin keeps using the client it got.
+apis = TTLCache(maxsize=API_CLIENTS, ttl=API_CLIENT_IDLE_TTL)
+apis_lock = threading.Lock()
+
+
+def get_headers(token) -> dict:
+    headers = {
+        "Authorization": "Bearer " + token,
+        "Content-Type": "application/json",
+        "Accept": "application/json"
+    }
+    return headers
+
+
+# Returns the SDK client for a token. Clients are reused and send their requests through the shared pool.
+def get_api(token) -> WebexTeamsAPI:
+    with apis_lock:
+        api = apis.get(token)
+        if api is None:
+            api = WebexTeamsAPI(access_token=token, base_url=API_URL, single_request_timeout=int(READ_TIMEOUT))
+            # The SDK keeps its own requests session; route it through the shared adapter and its pool
+            api._session._req_session.mount("https://", adapter)
+            api._session._req_session.mount("http://", adapter)
+        apis.set(token, api)  # kept for another API_CLIENT_IDLE_TTL seconds
+        return api
@@ -1,65 +1,135 @@
+import asyncio
 import os
-import webexteamssdk
+from collections import Counter
+import aio
+import transport
 
 URL = os.environ.get("BOT_URL")
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 BOT_ID = os.environ.get("BOT_ID")
 BOT_PORT = os.environ.get("BOT_PORT")
-api = webexteamssdk.WebexTeamsAPI(access_token=BOT_TOKEN)
+
+# Fields Webex can't change on an existing webhook. A webhook differing in one of them is replaced.
+FIXED_FIELDS = ("resource", "event", "filter")
+
+
+# The webhooks the bot needs, by name. Filters keep Webex from delivering events the bot would drop: in
+# group rooms only messages mentioning the bot (so not the bot's own), and only the bot's own memberships.
+def desired_webhooks(url=URL, bot_id=BOT_ID) -> dict:
+    return {
+        "MentionWebhook": {"targetUrl": url + "/mention", "resource": "messages", "event": "created",
+                           "filter": "roomType=group&mentionedPeople=me"},
+        "DirectMessageWebhook": {"targetUrl": url + "/mention", "resource": "messages", "event": "created",
+                                 "filter": "roomType=direct"},
+        "CardWebhook": {"targetUrl": url + "/card", "resource": "attachmentActions", "event": "created"},
+        "AddedToRoomWebhook": {"targetUrl": url + "/added", "resource": "memberships", "event": "created",
+                               "filter": "personId=" + bot_id},
+        "RemovedFromRoomWebhook": {"targetUrl": url + "/removed", "resource": "memberships", "event": "deleted",
+                                   "filter": "personId=" + bot_id},
+    }
+
+
+# Makes the token's webhooks match the desired ones: missing ones are created, changed ones updated (or
+# replaced if Webex can't update them), inactive ones reactivated and any others deleted. Unchanged webhooks
+# are left alone. The calls are made concurrently. Returns the webhooks as they are afterwards, or None if
+# they could not be listed.
+async def reconcile(token, desired) -> list:
+    existing = await list_webhooks(token)
+    if existing is None:
+        return None
+    current = {}
+    extra = []
+    # of several webhooks with the same name, the one needing no change is kept
+    existing.sort(key=lambda webhook: not is_unchanged(webhook, desired.get(webhook.get("name"))))
+    for webhook in existing:
+        if webhook.get("name") in desired and webhook["name"] not in current:
+            current[webhook["name"]] = webhook
+        else:
+            extra.append(webhook)  # not needed, or a duplicate
+
+    changes = []  # (what is done, call doing it)
+    unchanged = []
+    for name, spec in desired.items():
+        webhook = current.get(name)
+        if webhook is None:
+            changes.append(("created", create_webhook(token, name, spec)))
+        elif any(webhook.get(field) != spec.get(field) for field in FIXED_FIELDS):
+            changes.append(("replaced", replace_webhook(token, webhook, name, spec)))
+        elif not is_unchanged(webhook, spec):
+            changes.append(("updated", update_webhook(token, webhook, name, spec)))
+        else:
+            unchanged.append(webhook)
+    changes.extend(("deleted", delete_webhook(token, webhook)) for webhook in extra)
+    results = await asyncio.gather(*(change for done, change in changes))
+
+    webhooks = list(unchanged)
+    counts = Counter()
+    for (done, _), result in zip(changes, results):
+        counts[done if result is not None else "failed"] += 1
+        if result is not None and done != "deleted":
+            webhooks.append(result)
+    print(f"Webhooks: {len(unchanged)} unchanged" + "".join(f", {count} {done}" for done, count in counts.items()))
+    return webhooks
+
+
+def is_unchanged(webhook, spec) -> bool:
+    return (spec is not None and all(webhook.get(field) == spec.get(field) for field in FIXED_FIELDS + ("targetUrl",))
+            and webhook.get("status", "active") == "active")
+
+
+async def list_webhooks(token):
+    return await aio.list_items("webhooks", token, {"max": 100})
+
+
+# Sends one webhook call. Returns the response's JSON, True if there is none, or None if the call failed.
+async def call(method, path, token, action, **kwargs):
+    try:
+        response = await aio.request(method, path, token, **kwargs)
+    except aio.ERRORS as e:
+        print(f"Could not {action}: {e!r}")
+        return None
+    if not response.ok:
+        print(f"Could not {action}. Response: {response.content[:200]}")
+        return None
+    try:
+        return response.json() if response.content else True
+    except ValueError:
+        return True  # done, even if the answer is not JSON
+
+
+async def create_webhook(token, name, spec):
+    return await call("POST", "webhooks", token, f"create webhook {name}", json=dict(spec, name=name))
+
+
+async def update_webhook(token, webhook, name, spec):
+    return await call("PUT", f"webhooks/{webhook['id']}", token, f"update webhook {name}",
+                      json={"name": name, "targetUrl": spec["targetUrl"], "status": "active"})
+
+
+# Creates the new webhook before deleting the old one, so no event is missed in between
+async def replace_webhook(token, webhook, name, spec):
+    created = await create_webhook(token, name, spec)
+    if created is not None:
+        await delete_webhook(token, webhook)
+    return created
+
+
+async def delete_webhook(token, webhook):
+    return await call("DELETE", f"webhooks/{webhook['id']}", token,
+                      f"delete webhook {webhook.get('name') or webhook['id']}")
 
 
 def create_webhooks() -> None:
-    webhooks = []
     print("Creating webhooks")
-    webhooks.append(
-        api.webhooks.create(
-            name="MentionWebhook",
-            targetUrl=URL + "/mention",
-            resource="messages",
-            event="created",
-        )
-    )
-    print("Webhook created")
-    webhooks.append(
-        api.webhooks.create(
-            name="CardWebhook",
-            targetUrl=URL + "/card",
-            resource="attachmentActions",
-            event="created",
-        )
-    )
-    print("Webhook created")
-    webhooks.append(
-        api.webhooks.create(
-            name="AddedToRoomWebhook",
-            targetUrl=URL + "/added",
-            resource="memberships",
-            event="created",
-            filter="personId=" + BOT_ID
-        )
-    )
-    print("Webhook created")
-    webhooks.append(
-        api.webhooks.create(
-            name="RemovedFromRoomWebhook",
-            targetUrl=URL + "/removed",
-            resource="memberships",
-            event="deleted",
-            filter="personId=" + BOT_ID
-        )
-    )
-    print("Webhook created")
+    aio.run(reconcile(BOT_TOKEN, desired_webhooks()))
 
 
 def delete_webhooks() -> None:
-    webhooks = api.webhooks.list()
     print("Deleting webhooks")
-    for webhook in webhooks:
-        api.webhooks.delete(webhook.id)
-        print("Webhook deleted")
+    aio.run(reconcile(BOT_TOKEN, {}))
 
 
 def print_webhooks() -> None:
-    webhooks = api.webhooks.list()
+    webhooks = transport.get_api(BOT_TOKEN).webhooks.list()
     for webhook in webhooks:
         print(webhook)
@@ -0,0 +1,128 @@
+from __future__ import print_function  # Needed if you want to have console output using Flask
+import difflib
+import os
+import re
+import threading
+import time
+import aio
+
+WORKSPACE_INDEX_INTERVAL = float(os.environ.get("WORKSPACE_INDEX_INTERVAL", 600))  # seconds between refreshes
+WORKSPACE_PAGE_SIZE = int(os.environ.get("WORKSPACE_PAGE_SIZE", 500))  # workspaces per listing request
+SUGGESTION_CUTOFF = 0.8  # how similar a name must be to be suggested, from 0 to 1
+SUGGESTIONS = 3  # most names suggested for one typed name
+NUMBERS = re.compile(r"\d+")
+
+
+# Local copy of an org's workspaces, so names are looked up without asking the API. Listed page by page in
+# the background and refreshed every WORKSPACE_INDEX_INTERVAL seconds; workspaces the bot creates are added
+# right away. Also suggests existing names for typed names that are close, e.g. typos.
+class WorkspaceIndex:
+
+    def __init__(self, org_id):
+        self.org_id = org_id
+        self.lock = threading.Lock()
+        self.by_name = {}  # display name -> workspace ID
+        self.by_key = {}  # lowercase name -> display name
+        self.changed_at = {}  # display name -> when the bot added or removed it
+        self.synced_at = None  # when the last listing completed
+        self.version = 0  # changes whenever the names change
+        self.syncing = False
+
+    def __len__(self):
+        return len(self.by_name)
+
+    # Returns the display name of a workspace matching the name in any case, empty if there is none
+    def find(self, name) -> str:
+        return self.by_key.get(name.strip().lower(), "")
+
+    def get_id(self, name) -> str:
+        return self.by_name.get(name, "")
+
+    def add(self, name, workspace_id) -> None:
+        with self.lock:
+            if self.by_name.get(name) != workspace_id:
+                self.by_name[name] = workspace_id
+                self.by_key[name.lower()] = name
+                self.changed_at[name] = time.monotonic()
+                self.version += 1
+
+    def remove(self, name) -> None:
+        with self.lock:
+            if self.by_name.pop(name, None) is not None:
+                self.by_key.pop(name.lower(), None)
+                self.changed_at[name] = time.monotonic()
+                self.version += 1
+
+    def names(self) -> list:
+        with self.lock:
+            return sorted(self.by_name, key=str.lower)
+
+    # Existing names close to a name, most similar first. Names that only differ in their numbers (Room-11
+    # and Room-12) are told apart on purpose and not suggested.
+    def suggest(self, name) -> list:
+        key = name.strip().lower()
+        with self.lock:
+            keys = list(self.by_key)
+        if not keys:
+            return []
+        matches = difflib.get_close_matches(key, keys, n=len(keys), cutoff=SUGGESTION_CUTOFF)
+        pattern = NUMBERS.sub("#", key)
+        return [self.by_key[match] for match in matches if NUMBERS.sub("#", match) != pattern][:SUGGESTIONS]
+
+    def is_stale(self) -> bool:
+        return self.synced_at is None or time.monotonic() - self.synced_at > WORKSPACE_INDEX_INTERVAL
+
+    # Starts a refresh on the async client, unless the index is recent or a refresh is running already
+    def refresh_soon(self, token) -> None:
+        with self.lock:
+            if self.syncing or not self.is_stale():
+                return
+            self.syncing = True
+        aio.submit(self.refresh(token))
+
+    # Lists the org's workspaces and applies the difference to the index
+    async def refresh(self, token) -> None:
+        try:
+            started_at = time.monotonic()
+            workspaces = await list_workspaces(self.org_id, token)
+            if workspaces is None:
+                return
+            listed = {workspace["displayName"]: workspace["id"] for workspace in workspaces}
+            with self.lock:
+                # changes the bot made while listing are newer than the listing
+                recent = {name for name, changed_at in self.changed_at.items() if changed_at >= started_at}
+                added = [name for name, workspace_id in listed.items()
+                         if self.by_name.get(name) != workspace_id and name not in recent]
+                removed = [name for name in self.by_name if name not in listed and name not in recent]
+                for name in added:
+                    self.by_name[name] = listed[name]
+                    self.by_key[name.lower()] = name
+                for name in removed:
+                    del self.by_name[name]
+                    self.by_key.pop(name.lower(), None)
+                self.changed_at = {name: self.changed_at[name] for name in recent}
+                if added or removed:
+                    self.version += 1
+                self.synced_at = time.monotonic()
+            print(f"Workspace index of org {self.org_id}: {len(self.by_name)} workspaces, {len(added)} added, "
+                  f"{len(removed)} removed.")
+        finally:
+            self.syncing = False
+
+
+indexes = {}  # one index per org
+indexes_lock = threading.Lock()
+
+
+def get_index(org_id) -> WorkspaceIndex:
+    with indexes_lock:
+        index = indexes.get(org_id)
+        if index is None:
+            index = WorkspaceIndex(org_id)
+            indexes[org_id] = index
+        return index
+
+
+# Lists all workspaces of an org, following the pages of the listing. Returns None if a request failed.
+async def list_workspaces(org_id, token):
+    return await aio.list_items("workspaces", token, {"orgId": org_id, "max": WORKSPACE_PAGE_SIZE})
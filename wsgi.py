@@ -0,0 +1,4 @@
+# Entry point for WSGI servers, e.g.: gunicorn -w 4 -b 0.0.0.0:$BOT_PORT wsgi:app
+from app import create_app
+
+app = create_app()